@@ -0,0 +1,101 @@
+"""Asynchronous parallel Bayesian optimisation over a 1D candidate grid.
+
+A pool of worker processes is kept busy evaluating the objective. As soon
+as any evaluation finishes, its result is added to the GP and a new point
+is proposed for the free worker, treating the evaluations still running
+as Kriging-believer fantasies so workers don't all pile onto the same
+point.
+"""
+import os
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+from skopt.learning.gaussian_process.kernels import RBF
+
+from gp_utils import IncrementalGP, lcb
+from batch_acquisition import kriging_believer
+from simulate_reading import Corpus, read_text, word_count
+
+
+@lru_cache(maxsize=None)
+def _load_corpus(path):
+    return Corpus.load(path)
+
+
+def text_wps(font_size, path="war_peace.txt", portion=1.0):
+    """Seconds per word to read (a portion of) a text file at a font size,
+    like the notebook's war_peace_wps. Module level, so it can be sent to
+    worker processes; each worker maps the cached corpus only once."""
+    corpus = _load_corpus(os.path.abspath(path)).portion(portion)
+    return read_text(corpus, font_size) / word_count(corpus)
+
+
+def _propose(gp, candidates, pending, acquisition, **kwargs):
+    y_pred, y_cov = gp.predict(candidates, return_cov=True)
+    pending = [int(np.argmin(np.abs(candidates - x))) for x in pending]
+    j = kriging_believer(y_pred, y_cov, 1, acquisition, noise=gp.alpha, pending=pending, **kwargs)[0]
+    return candidates[j]
+
+
+def _result(gp, xs, ys, start):
+    best = int(np.argmin(ys))
+    return {"x": xs[best], "fun": ys[best], "x_iters": xs, "func_vals": ys,
+            "wall_time": time.perf_counter() - start, "gp": gp}
+
+
+def async_minimize(objective, candidates, n_calls, n_workers=4, kernel=None, alpha=0.1,
+                   acquisition=lcb, **kwargs):
+    """Minimise objective(x) over the candidates with n_workers evaluations
+    in flight at once. kwargs are passed to the acquisition function (e.g.
+    kappa=4 for lcb).
+
+    Returns a dictionary with the best point `x` and value `fun`, the
+    evaluated points and values in completion order (`x_iters`,
+    `func_vals`), the total `wall_time`, and the fitted `gp`.
+    """
+    candidates = np.asarray(candidates, dtype=np.float64)
+    gp = IncrementalGP(kernel or RBF(5.0, "fixed"), alpha)
+    xs, ys, pending = [], [], {}
+    submitted = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(n_workers) as pool:
+        while submitted < n_calls or pending:
+            while len(pending) < n_workers and submitted < n_calls:
+                x = _propose(gp, candidates, list(pending.values()), acquisition, **kwargs)
+                pending[pool.submit(objective, x)] = x
+                submitted += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                x = pending.pop(future)
+                y = future.result()
+                gp.add(x, y)
+                xs.append(x)
+                ys.append(y)
+    return _result(gp, xs, ys, start)
+
+
+def serial_minimize(objective, candidates, n_calls, kernel=None, alpha=0.1, acquisition=lcb, **kwargs):
+    """The same optimisation, one evaluation at a time in this process, as
+    in the notebook's BO loop"""
+    candidates = np.asarray(candidates, dtype=np.float64)
+    gp = IncrementalGP(kernel or RBF(5.0, "fixed"), alpha)
+    xs, ys = [], []
+    start = time.perf_counter()
+    for i in range(n_calls):
+        x = _propose(gp, candidates, [], acquisition, **kwargs)
+        y = objective(x)
+        gp.add(x, y)
+        xs.append(x)
+        ys.append(y)
+    return _result(gp, xs, ys, start)
+
+
+def compare(objective, candidates, n_calls, n_workers=4, **kwargs):
+    """Run the serial and asynchronous optimisers with the same budget and
+    report the wall-clock speedup of the asynchronous one"""
+    serial = serial_minimize(objective, candidates, n_calls, **kwargs)
+    parallel = async_minimize(objective, candidates, n_calls, n_workers, **kwargs)
+    return {"serial": serial, "async": parallel,
+            "speedup": serial["wall_time"] / parallel["wall_time"]}
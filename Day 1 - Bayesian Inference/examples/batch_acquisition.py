@@ -0,0 +1,106 @@
+"""Batch (q-point) acquisition, for running several experiments per round.
+
+All acquisition functions here follow the convention used in the
+notebooks' BO loops: lower scores are better, and the next point is the
+argmin (as with `lcb`, and `ei`, which returns negative expected
+improvement). Each proposal step scores the whole candidate grid with
+array operations; nothing loops over candidates.
+"""
+import numpy as np
+import scipy.stats
+
+from gp_utils import lcb
+
+
+def kriging_believer(y_pred, y_cov, q, acquisition=lcb, noise=0.0, pending=(), **kwargs):
+    """Choose q candidate indices by Kriging believer: after each pick, the
+    GP is conditioned on a fantasy observation equal to its own mean
+    there. The mean is unchanged by such an observation, and the
+    variance shrinks by a rank-one update, so each pick costs O(m * q).
+
+    y_pred: (m,) predictive mean over the candidates
+    y_cov: (m, m) predictive covariance, e.g. from
+        gp.predict(xs, return_cov=True)
+    noise: observation noise variance of the fantasies (the GP's alpha)
+    pending: candidate indices already being evaluated; these are added
+        as fantasies before anything is chosen, and never chosen again
+    """
+    y_pred = np.asarray(y_pred).squeeze()
+    y_cov = np.asarray(y_cov)
+    m = len(y_pred)
+    var = np.array(np.diag(y_cov), dtype=np.float64)
+    pending = np.asarray(pending, dtype=int)
+    p = len(pending)
+    # rows of the accumulated rank-one downdates, so cov = y_cov - U.T @ U
+    U = np.zeros((p + q, m))
+    chosen = np.zeros(p + q, dtype=int)
+    chosen[:p] = pending
+    for k in range(p + q):
+        if k >= p:
+            score = np.array(acquisition(y_pred, np.sqrt(np.clip(var, 0, None)), **kwargs), dtype=np.float64)
+            score[chosen[:k]] = np.inf
+            chosen[k] = np.argmin(score)
+        j = chosen[k]
+        column = y_cov[:, j] - U[:k].T @ U[:k, j]
+        U[k] = column / np.sqrt(max(column[j] + noise, 1e-12))
+        var -= U[k] ** 2
+    return chosen[p:]
+
+
+def lipschitz_constant(y_pred, xs):
+    """Estimate a Lipschitz constant of the mean from its largest gradient
+    over a 1D candidate grid"""
+    return max(np.max(np.abs(np.gradient(np.asarray(y_pred).squeeze(), np.ravel(xs)))), 1e-7)
+
+
+def local_penalization(y_pred, y_std, xs, q, acquisition=lcb, lipschitz=None, **kwargs):
+    """Choose q candidate indices by local penalisation (Gonzalez et al.,
+    2016): the acquisition is scored once, then after each pick it is
+    multiplied by a soft exclusion zone around that point, whose radius
+    is how far the function would have to move (at Lipschitz constant L)
+    to improve on the best mean.
+
+    y_pred, y_std: (m,) predictive mean and std. dev. over the candidates
+    xs: candidate locations, (m,) or (m, d)
+    lipschitz: L, estimated from the mean on a 1D grid if not given
+    """
+    y_pred = np.asarray(y_pred).squeeze()
+    y_std = np.asarray(y_std).squeeze()
+    xs = np.asarray(xs, dtype=np.float64)
+    if xs.ndim == 1:
+        xs = xs[:, None]
+    if lipschitz is None:
+        lipschitz = lipschitz_constant(y_pred, xs)
+    best = np.min(y_pred)
+    score = np.asarray(acquisition(y_pred, y_std, **kwargs), dtype=np.float64)
+    # turn lower-is-better scores into a non-negative utility to multiply
+    utility = np.max(score) - score
+    chosen = np.zeros(q, dtype=int)
+    taken = np.zeros(len(utility), dtype=bool)
+    for k in range(q):
+        # never pick the same point twice, even if the penalty underflows
+        j = np.argmax(np.where(taken, -np.inf, utility))
+        chosen[k] = j
+        taken[j] = True
+        distance = np.linalg.norm(xs - xs[j], axis=1)
+        z = (lipschitz * distance - (y_pred[j] - best)) / (y_std[j] + 1e-9)
+        utility *= scipy.stats.norm.cdf(z)
+    return chosen
+
+
+def propose_batch(gp, xs, q, method="believer", acquisition=lcb, **kwargs):
+    """Propose q points from the candidate grid xs for the next round of
+    parallel experiments, using `kriging_believer` or `local_penalization`.
+    Returns the chosen candidates."""
+    xs = np.asarray(xs)
+    column = xs[:, None] if xs.ndim == 1 else xs
+    if method == "believer":
+        y_pred, y_cov = gp.predict(column, return_cov=True)
+        noise = kwargs.pop("noise", getattr(gp, "alpha", 0.0))
+        chosen = kriging_believer(y_pred, y_cov, q, acquisition, noise=np.max(noise), **kwargs)
+    elif method == "penalization":
+        y_pred, y_std = gp.predict(column, return_std=True)
+        chosen = local_penalization(y_pred, y_std, xs, q, acquisition, **kwargs)
+    else:
+        raise ValueError(f"Unknown batch method {method}")
+    return xs[chosen]
@@ -0,0 +1,120 @@
+"""Headless replay of FilterCanvas pipelines, for benchmarking.
+
+A trace is a 1D array with one entry per filter tick: the normalised
+mouse x position observed on that tick, or NaN if there was no
+observation. FilterCanvas records one in its `trace` attribute, e.g.
+`trace = np.array(c.trace)`.
+"""
+import time
+import itertools
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+
+def synthetic_swipe(direction, n_ticks=60, onset=10, duration=15, noise=0.01):
+    """Make a trace of a swipe in the given direction (-1 or 1): no
+    observations before `onset`, then the pointer moves out over
+    `duration` ticks and stays there"""
+    trace = np.full(n_ticks, np.nan)
+    phase = np.clip((np.arange(n_ticks - onset) + 1) / duration, 0, 1)
+    trace[onset:] = direction * phase + np.random.normal(0, noise, n_ticks - onset)
+    return trace
+
+
+def _timed(fn, name, timings):
+    def timed_fn(*args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings[name] += time.perf_counter() - start
+        return result
+
+    return timed_fn
+
+
+def replay(pf, trace, estimator=None, trigger=None, onset=None, dt=0.05):
+    """Run a trace through a filter, estimator and trigger exactly as
+    FilterCanvas.simulate does, but without a canvas.
+
+    onset: tick at which the gesture starts (default: the first
+    observation). dt: the tick period the trace was recorded at, used to
+    convert the decision latency to seconds of interaction time.
+
+    Returns a dictionary of statistics: updates per second, mean time per
+    tick (ms) for each stage, and the decision latency from onset until
+    the trigger first fires (in ticks, interaction seconds and wall-clock
+    seconds; NaN if it never fired).
+    """
+    trace = np.asarray(trace, dtype=np.float64)
+    if onset is None:
+        observed = np.flatnonzero(~np.isnan(trace))
+        onset = observed[0] if len(observed) else 0
+
+    timings = defaultdict(float)
+    # time the filter's own stages by wrapping them for the duration of the replay
+    stages = ["dynamics_fn", "noise_fn", "observe_fn", "weight_fn"]
+    originals = {name: getattr(pf, name) for name in stages}
+    for name, fn in originals.items():
+        setattr(pf, name, _timed(fn, name[:-3], timings))
+
+    action, fired, fired_action, onset_time, fired_time = "no", None, "no", None, None
+    try:
+        loop_start = time.perf_counter()
+        for i, obs in enumerate(trace):
+            start = time.perf_counter()
+            if i == onset:
+                onset_time = start
+            if np.isnan(obs):
+                pf.update()
+            else:
+                pf.update(np.array([obs]))
+            now = time.perf_counter()
+            timings["update"] += now - start
+
+            if estimator:
+                probs = estimator(pf.original_particles)
+                timings["estimate"] += time.perf_counter() - now
+                now = time.perf_counter()
+                if trigger:
+                    action = trigger(probs)
+                    timings["trigger"] += time.perf_counter() - now
+                    now = time.perf_counter()
+
+            if fired is None and i >= onset and action != "no":
+                fired, fired_action, fired_time = i, action, now
+        elapsed = time.perf_counter() - loop_start
+    finally:
+        for name, fn in originals.items():
+            setattr(pf, name, fn)
+
+    n = len(trace)
+    stats = {"ticks": n, "updates_per_s": n / elapsed}
+    for name, total in timings.items():
+        stats[f"{name}_ms"] = 1000.0 * total / n
+    if fired is None:
+        stats.update(action="no", latency_ticks=np.nan, latency_s=np.nan, latency_wall_s=np.nan)
+    else:
+        stats.update(action=fired_action, latency_ticks=fired - onset, latency_s=(fired - onset) * dt,
+                     latency_wall_s=fired_time - onset_time)
+    return stats
+
+
+def benchmark(make_filter, traces, estimator=None, trigger=None,
+              n_particles=(50, 100, 200, 500), resample_proportions=(0.01, 0.05),
+              repeats=3, dt=0.05):
+    """Replay every trace against fresh filters for each combination of
+    particle count and resample proportion.
+
+    make_filter(n_particles, resample_proportion) should build the filter,
+    e.g. a ParticleFilter with the notebook's prior/dynamics/observe/weight.
+    Returns a DataFrame with one row per replay (see `replay` for columns).
+    """
+    rows = []
+    for n, proportion in itertools.product(n_particles, resample_proportions):
+        for i, trace in enumerate(traces):
+            for repeat in range(repeats):
+                pf = make_filter(n_particles=n, resample_proportion=proportion)
+                stats = replay(pf, trace, estimator, trigger, dt=dt)
+                rows.append({"n_particles": n, "resample_proportion": proportion,
+                             "trace": i, "repeat": repeat, **stats})
+    return pd.DataFrame(rows)
@@ -1,4 +1,6 @@
+from collections import OrderedDict
 import scipy.stats
+import scipy.linalg
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -32,29 +34,106 @@ def render_gp(ax, xs, gp):
     plot_gp_samples(ax, xs[:,0], ys, c='w', alpha=0.1)
 
 
+_prediction_cache = OrderedDict()
+
+
+def gp_state_key(gp, xs):
+    """A key that changes whenever the GP's training data (or xs) does"""
+    if hasattr(gp, "state_key"):
+        return (id(gp), gp.state_key(), hash(np.asarray(xs).tobytes()))
+    X = getattr(gp, "X_train_", getattr(gp, "X", None))
+    y = getattr(gp, "y_train_", getattr(gp, "y", None))
+    data = b"" if X is None else np.asarray(X).tobytes() + np.asarray(y).tobytes()
+    return (id(gp), hash(data), hash(np.asarray(xs).tobytes()))
+
+
+def cached_predict(gp, xs, n_samples=0, max_sample_points=200, maxsize=16):
+    """gp.predict(xs, return_std=True), plus n_samples posterior samples,
+    memoised on the GP's training data so redraws of an unchanged GP are
+    free. Sampling needs the full covariance, which is cubic in the number
+    of points, so samples are drawn at no more than max_sample_points of
+    the xs. Returns (y_pred, y_std, sample_xs, samples)."""
+    key = gp_state_key(gp, xs) + (n_samples, max_sample_points)
+    if key not in _prediction_cache:
+        y_pred, y_std = gp.predict(xs, return_std=True)
+        sample_xs, samples = None, None
+        if n_samples:
+            sample_xs = xs[:: int(np.ceil(len(xs) / max_sample_points))]
+            samples = gp.sample_y(sample_xs, n_samples).reshape(len(sample_xs), n_samples)
+        _prediction_cache[key] = (np.ravel(y_pred), np.ravel(y_std), sample_xs, samples)
+        if len(_prediction_cache) > maxsize:
+            _prediction_cache.popitem(last=False)
+    return _prediction_cache[key]
+
+
+class GPRaster:
+    """A fast alternative to render_gp for large candidate grids and live
+    redraws. The predictive density is drawn as a single image instead of
+    50 fill_between bands, and the artists are kept so that `draw` only
+    updates their data, and only when the GP has changed."""
+
+    def __init__(self, ax, xs, n_samples=20, resolution=256):
+        self.ax = ax
+        self.xs = xs[:, None] if len(xs.shape) == 1 else xs
+        self.n_samples = n_samples
+        self.resolution = resolution
+        self.key = None
+        self.image = None
+
+    def draw(self, gp):
+        key = gp_state_key(gp, self.xs)
+        if key == self.key:
+            return self
+        self.key = key
+        y_pred, y_std, sample_xs, samples = cached_predict(gp, self.xs, self.n_samples)
+        x = self.xs[:, 0]
+        # same scale as render_gp: the bands are +/- 2 std. dev. per unit of z
+        lo = np.min(y_pred - 6 * y_std)
+        hi = np.max(y_pred + 6 * y_std)
+        ys = np.linspace(lo, hi, self.resolution)
+        z = (ys[:, None] - y_pred[None, :]) / (2 * y_std[None, :] + 1e-12)
+        density = np.exp(-0.5 * z**2) / np.sqrt(2 * np.pi)
+        extent = [x[0], x[-1], lo, hi]
+
+        if self.image is None:
+            self.image = self.ax.imshow(density, cmap=cmap, vmin=0, vmax=1, origin="lower",
+                                        aspect="auto", extent=extent, interpolation="bilinear")
+            (self.mean_line,) = self.ax.plot(x, y_pred, c="k")
+            self.sample_lines = []
+            if samples is not None:
+                self.sample_lines = self.ax.plot(sample_xs[:, 0], samples, c="w", alpha=0.1)
+            self.ax.set_xlabel("Font size")
+            self.ax.set_ylabel("Reading speed (seconds per word)")
+        else:
+            self.image.set_data(density)
+            self.image.set_extent(extent)
+            self.mean_line.set_ydata(y_pred)
+            for line, sample in zip(self.sample_lines, samples.T if samples is not None else []):
+                line.set_ydata(sample)
+        self.ax.set_ylim(lo, hi)
+        return self
+
+
+def render_gp_raster(ax, xs, gp, n_samples=20):
+    """Like render_gp, but drawn as a raster; see GPRaster. Returns the
+    GPRaster, whose draw(gp) can be called again to update the plot."""
+    return GPRaster(ax, xs, n_samples).draw(gp)
+
+
 def pi(y_pred, y_std):
     
     y_pred = y_pred.squeeze()
-    best = max(y_pred)
+    best = np.max(y_pred)
     # calculate the probability of improvement
     return scipy.stats.norm(0, 1).cdf((y_pred - best) / (y_std + 1e-7))
 
 
-def ei(y_pred, y_std, xi=0):
-    y_pred = y_pred.squeeze()
-    norm = scipy.stats.norm(0, 1)    
-    best = max(y_pred)
-    Z = (y_pred - best - xi) / (y_std + 1e-9)
-    # calculate the expected improvement
-    return norm.cdf(Z) * (y_pred - best - xi) + y_std * norm.pdf(Z)
-
-
 def ei(mu, std, xi=0):
     mu = mu.squeeze()
     std = std.squeeze()
     values = np.zeros_like(mu)
     mask = std > 0
-    y_opt = max(mu)
+    y_opt = np.max(mu)
     improve = y_opt - xi - mu[mask]
     scaled = improve / std[mask]
     cdf = scipy.stats.norm.cdf(scaled)
@@ -79,3 +158,200 @@ from skopt.learning.gaussian_process.kernels import (
 )
 
 
+class IncrementalGP:
+    """A zero-mean GP regressor that takes observations one at a time.
+
+    Each `add` extends the Cholesky factor of K(X, X) + alpha*I by one row
+    instead of refactorising it, so a new observation costs O(n^2) rather
+    than O(n^3). If `candidates` is given (e.g. `font_sizes`), the
+    predictive mean and std. dev. at those points are also kept up to date
+    in O(n * m) per observation, and `predict(candidates)` is free.
+
+    kernel is a scikit-learn/skopt kernel, e.g. `RBF(5.0, "fixed")`; it is
+    not optimised. Has the same `predict(xs, return_std)` and `sample_y`
+    interface as GaussianProcessRegressor, so it works with `render_gp`.
+    """
+
+    def __init__(self, kernel, alpha=1e-10, candidates=None):
+        self.kernel = kernel
+        self.alpha = alpha
+        self.n = 0
+        self._L = np.zeros((0, 0))
+        self.X = None
+        self.y = np.zeros(0)
+        # z solves L z = y; mean predictions are (L^-1 K(X, xs))^T z
+        self._z = np.zeros(0)
+        self.candidates = None
+        if candidates is not None:
+            self.candidates = _as_column(candidates)
+            self._V = np.zeros((0, len(self.candidates)))
+            self._prior_var = self.kernel.diag(self.candidates)
+            self._var = np.array(self._prior_var)
+
+    def _grow(self):
+        # buffers double in size, so appending is amortised O(n) per row
+        capacity = max(8, 2 * len(self._L))
+        L = np.zeros((capacity, capacity))
+        L[: self.n, : self.n] = self._L[: self.n, : self.n]
+        self._L = L
+        z = np.zeros(capacity)
+        z[: self.n] = self._z[: self.n]
+        self._z = z
+        if self.candidates is not None:
+            V = np.zeros((capacity, len(self.candidates)))
+            V[: self.n] = self._V[: self.n]
+            self._V = V
+
+    def add(self, x, y):
+        """Add one observation y at the point x"""
+        x = _as_column(x)
+        n = self.n
+        if n == len(self._L):
+            self._grow()
+        L = self._L[:n, :n]
+        if n > 0:
+            k = self.kernel(self.X, x)[:, 0]
+            l = scipy.linalg.solve_triangular(L, k, lower=True)
+        else:
+            l = np.zeros(0)
+        d = np.sqrt(max(self.kernel.diag(x)[0] + self.alpha - l @ l, 1e-12))
+        self._L[n, :n] = l
+        self._L[n, n] = d
+        self._z[n] = (y - l @ self._z[:n]) / d
+        if self.candidates is not None:
+            v = (self.kernel(x, self.candidates)[0] - l @ self._V[:n]) / d
+            self._V[n] = v
+            self._var -= v**2
+        self.X = x if self.X is None else np.vstack([self.X, x])
+        self.y = np.append(self.y, y)
+        self.n = n + 1
+        return self
+
+    def fit(self, X, y):
+        """Add a batch of observations, one at a time"""
+        for x_i, y_i in zip(_as_column(X), np.ravel(y)):
+            self.add(x_i.reshape(1, -1), y_i)
+        return self
+
+    def _solve(self, xs):
+        """Return L^-1 K(X, xs)"""
+        L = self._L[: self.n, : self.n]
+        return scipy.linalg.solve_triangular(L, self.kernel(self.X, xs), lower=True)
+
+    def predict(self, xs, return_std=False, return_cov=False):
+        xs = _as_column(xs)
+        if return_cov:
+            cov = self.kernel(xs)
+            if self.n == 0:
+                return np.zeros(len(xs)), cov
+            V = self._solve(xs)
+            return V.T @ self._z[: self.n], cov - V.T @ V
+        if self.candidates is not None and xs.shape == self.candidates.shape and np.array_equal(xs, self.candidates):
+            V = self._V[: self.n]
+            mean = V.T @ self._z[: self.n]
+            var = self._var
+        elif self.n == 0:
+            mean = np.zeros(len(xs))
+            var = self.kernel.diag(xs)
+        else:
+            V = self._solve(xs)
+            mean = V.T @ self._z[: self.n]
+            var = self.kernel.diag(xs) - np.sum(V**2, axis=0)
+        if return_std:
+            return mean, np.sqrt(np.clip(var, 0, None))
+        return mean
+
+    def sample_y(self, xs, n_samples=1, random_state=None):
+        mean, cov = self.predict(xs, return_cov=True)
+        rng = np.random.default_rng(random_state)
+        return rng.multivariate_normal(mean, cov, n_samples, method="eigh").T
+
+
+class SparseGP:
+    """An inducing-point GP approximation for long studies with thousands
+    of noisy observations.
+
+    Only the m inducing points are kept, together with two sufficient
+    statistics of the data: A = K_mn L^-1 K_nm and b = K_mn L^-1 y, where
+    L is the diagonal noise (alpha for VFE; alpha plus the Nystrom residual
+    for FITC). Adding n observations costs O(n m^2) and memory is O(m^2),
+    independent of n. The m x m system is refactorised lazily, once per
+    batch of predictions.
+
+    Same `predict(xs, return_std/return_cov)` and `sample_y` interface as
+    GaussianProcessRegressor, so it works with `render_gp` and the
+    acquisition functions.
+    """
+
+    def __init__(self, kernel, inducing, alpha=0.1, method="vfe", jitter=1e-8):
+        self.kernel = kernel
+        self.alpha = alpha
+        self.method = method
+        self.inducing = _as_column(inducing)
+        m = len(self.inducing)
+        self._Kmm = self.kernel(self.inducing) + jitter * np.eye(m)
+        self._Lmm = scipy.linalg.cholesky(self._Kmm, lower=True)
+        self.reset()
+
+    def reset(self):
+        m = len(self.inducing)
+        self.n = 0
+        self._A = np.zeros((m, m))
+        self._b = np.zeros(m)
+        self._L = None
+
+    def state_key(self):
+        return hash(self._b.tobytes()) ^ self.n
+
+    def add(self, X, y):
+        """Add one or more observations"""
+        X = _as_column(X)
+        y = np.ravel(y).astype(np.float64)
+        Kmn = self.kernel(self.inducing, X)
+        noise = np.full(len(X), float(self.alpha))
+        if self.method == "fitc":
+            V = scipy.linalg.solve_triangular(self._Lmm, Kmn, lower=True)
+            noise += np.clip(self.kernel.diag(X) - np.sum(V**2, axis=0), 0, None)
+        scaled = Kmn / noise
+        self._A += scaled @ Kmn.T
+        self._b += scaled @ y
+        self.n += len(X)
+        self._L = None
+        return self
+
+    def fit(self, X, y):
+        self.reset()
+        return self.add(X, y)
+
+    def _factor(self):
+        if self._L is None:
+            self._L = scipy.linalg.cholesky(self._Kmm + self._A, lower=True)
+            self._weights = scipy.linalg.cho_solve((self._L, True), self._b)
+        return self._L
+
+    def predict(self, xs, return_std=False, return_cov=False):
+        xs = _as_column(xs)
+        L = self._factor()
+        Kms = self.kernel(self.inducing, xs)
+        mean = Kms.T @ self._weights
+        # var = k** - Q** + K*m (Kmm + A)^-1 Km*
+        V1 = scipy.linalg.solve_triangular(self._Lmm, Kms, lower=True)
+        V2 = scipy.linalg.solve_triangular(L, Kms, lower=True)
+        if return_cov:
+            return mean, self.kernel(xs) - V1.T @ V1 + V2.T @ V2
+        if return_std:
+            var = self.kernel.diag(xs) - np.sum(V1**2, axis=0) + np.sum(V2**2, axis=0)
+            return mean, np.sqrt(np.clip(var, 0, None))
+        return mean
+
+    def sample_y(self, xs, n_samples=1, random_state=None):
+        mean, cov = self.predict(xs, return_cov=True)
+        rng = np.random.default_rng(random_state)
+        return rng.multivariate_normal(mean, cov, n_samples, method="eigh").T
+
+
+def _as_column(xs):
+    xs = np.asarray(xs, dtype=np.float64)
+    if xs.ndim < 2:
+        xs = xs.reshape(-1, 1)
+    return xs
@@ -1,12 +1,352 @@
 from threading import Event, Thread, Lock
+from collections import deque, namedtuple
 from ipycanvas import Canvas, hold_canvas
 from ipywidgets import Output, Button, Label
 import numpy as np
 from IPython.display import display
+from pfilter import squared_error
 import time
 
+def systematic_resample(weights, n=None, rng=None):
+    """Systematic resampling: return n (default len(weights)) indices drawn
+    in proportion to weights, using rng (default the global np.random)"""
+    n = len(weights) if n is None else n
+    rng = np.random if rng is None else rng
+    positions = (np.arange(n) + rng.uniform(0, 1)) / n
+    cumsum = np.cumsum(weights)
+    return np.minimum(np.searchsorted(cumsum / cumsum[-1], positions), len(weights) - 1)
+
+
+def forecast(particles, dynamics_fn, horizon, noise_fn=None, weights=None, steps=1):
+    """Propagate a particle set forward without observations.
+
+    particles: (N,D) array of states; it is not modified
+    dynamics_fn, noise_fn: as for the particle filter, (N,D) => (N,D)
+    horizon: number of forecast steps H
+    weights: optional N-element weight vector; if given, the set is
+        resampled once up front so the ensemble is equally weighted
+    steps: number of dynamics steps per forecast step
+
+    Returns an (H,N,D) array, the ensemble state after each forecast step.
+    All particles are stepped together, so the cost is H*steps calls to
+    dynamics_fn regardless of N.
+    """
+    x = np.array(particles)
+    if weights is not None:
+        x = x[systematic_resample(weights)]
+    out = np.empty((horizon,) + x.shape, dtype=x.dtype)
+    for h in range(horizon):
+        for _ in range(steps):
+            x = dynamics_fn(x)
+            if noise_fn is not None:
+                x = noise_fn(x)
+        out[h] = x
+    return out
+
+
+def systematic_resample_rows(weights):
+    """Systematic resampling of every row of an (S,N) weight array at once.
+    Returns an (S,N) array of particle indices for each row."""
+    s, n = weights.shape
+    positions = (np.arange(n)[None, :] + np.random.uniform(0, 1, (s, 1))) / n
+    cumsum = np.cumsum(weights, axis=1)
+    cumsum /= cumsum[:, -1:]
+    # offset each row by its row number so one searchsorted covers all rows
+    offset = np.arange(s)[:, None]
+    indices = np.searchsorted((cumsum + offset).ravel(), (positions + offset).ravel())
+    return np.minimum(indices.reshape(s, n) - offset * n, n - 1)
+
+
+class BatchParticleFilter:
+    """A bank of independent particle filters sharing one model, one per
+    input stream (e.g. each touch point, or each user).
+
+    particles is an (S,N,D) array and weights an (S,N) array. The model
+    functions have the same interface as for ParticleFilter and are called
+    once per update on all S*N particles flattened to an (S*N,D) array.
+    """
+    def __init__(self, prior_fn, n_streams, n_particles=200, dynamics_fn=None, noise_fn=None,
+                 observe_fn=None, weight_fn=None, resample_proportion=0.0, n_eff_threshold=1.0):
+        identity = lambda x: x
+        self.prior_fn = prior_fn
+        self.n_streams = n_streams
+        self.n_particles = n_particles
+        self.dynamics_fn = dynamics_fn or identity
+        self.noise_fn = noise_fn or identity
+        self.observe_fn = observe_fn or identity
+        self.weight_fn = weight_fn or squared_error
+        self.resample_proportion = resample_proportion
+        self.n_eff_threshold = n_eff_threshold
+        self.particles = self.prior_fn(n_streams * n_particles).reshape(n_streams, n_particles, -1)
+        self.weights = np.full((n_streams, n_particles), 1.0 / n_particles)
+        self.n_eff = np.ones(n_streams)
+        self.original_particles = np.array(self.particles)
+        self.original_weights = np.array(self.weights)
+
+    def _flat(self, fn, x):
+        s, n = self.n_streams, self.n_particles
+        return fn(x.reshape(s * n, -1)).reshape(s, n, -1)
+
+    def update(self, observed=None):
+        """Update every stream. observed is None (no observations), or an
+        (S,...) array with one observation per stream; streams whose
+        observation contains NaN are updated without one."""
+        s, n = self.n_streams, self.n_particles
+        self.particles = self._flat(self.noise_fn, self._flat(self.dynamics_fn, self.particles))
+        self.hypotheses = self._flat(self.observe_fn, self.particles)
+
+        weights = self.weights
+        if observed is not None:
+            observed = np.asarray(observed, dtype=np.float64).reshape(s, -1)
+            has_obs = ~np.any(np.isnan(observed), axis=1)
+            similarity = np.asarray(self.weight_fn(self.hypotheses.reshape(s * n, -1),
+                                                   np.repeat(observed, n, axis=0))).reshape(s, n)
+            weights = weights * np.where(has_obs[:, None], np.clip(similarity, 0, np.inf), 1.0)
+
+        total = np.sum(weights, axis=1, keepdims=True)
+        # a stream whose particles all got zero weight starts again uniformly
+        self.weights = np.where(total > 0, weights / np.where(total > 0, total, 1), 1.0 / n)
+        self.n_eff = (1.0 / np.sum(self.weights ** 2, axis=1)) / n
+        self.original_particles = np.array(self.particles)
+        self.original_weights = np.array(self.weights)
+        self.mean_state = np.sum(self.particles * self.weights[:, :, None], axis=1)
+
+        resample = self.n_eff < self.n_eff_threshold
+        if np.any(resample):
+            indices = systematic_resample_rows(self.weights[resample])
+            self.particles[resample] = np.take_along_axis(self.particles[resample], indices[:, :, None], axis=1)
+            self.weights[resample] = 1.0 / n
+
+        if self.resample_proportion > 0:
+            mask = np.random.random((s, n)) < self.resample_proportion
+            if np.any(mask):
+                self.particles[mask] = self.prior_fn(int(np.sum(mask)))
+
+
+class BufferedParticleFilter:
+    """A particle filter with the same interface as pfilter's
+    ParticleFilter (prior_fn, dynamics_fn, noise_fn, observe_fn, weight_fn,
+    resample_proportion, n_eff_threshold; update(observed);
+    original_particles / original_weights), but which keeps all of its
+    state in buffers allocated once up front. Everything after prior_fn
+    is keyword-only, as the positional order differs from pfilter's.
+
+    Resampling is systematic or stratified and writes into a second
+    particle buffer, which is then swapped with the first, so long-running
+    interactive loops churn the garbage collector much less (the model
+    functions' results and the resampled indices are still temporaries). Results returned
+    by the model functions are copied into the buffers, so they may either
+    modify their input in place or return new arrays. Pass
+    dtype=np.float32 to halve memory traffic.
+    """
+    def __init__(self, prior_fn, *, n_particles=200, dynamics_fn=None, noise_fn=None,
+                 observe_fn=None, weight_fn=None, resample_proportion=0.0,
+                 n_eff_threshold=1.0, resample="systematic", dtype=np.float64, seed=None):
+        identity = lambda x: x
+        self.prior_fn = prior_fn
+        self.dynamics_fn = dynamics_fn or identity
+        self.noise_fn = noise_fn or identity
+        self.observe_fn = observe_fn or identity
+        self.weight_fn = weight_fn or squared_error
+        self.resample_proportion = resample_proportion or 0.0
+        self.n_eff_threshold = n_eff_threshold
+        self.stratified = resample == "stratified"
+        self.dtype = dtype
+        self.rng = np.random.default_rng(seed)
+        self.resize(n_particles, prior_fn(n_particles))
+
+    def resize(self, n, particles=None):
+        """(Re)allocate all buffers for n particles. The new particles are
+        given, or resampled from the current set."""
+        if particles is None:
+            particles = self._front[systematic_resample(self.weights, n, self.rng)]
+        particles = np.asarray(particles)
+        d = particles.shape[1]
+        self.n_particles = n
+        self.d = d
+        self._front = np.array(particles, dtype=self.dtype)
+        self._back = np.empty((n, d), dtype=self.dtype)
+        self.original_particles = np.empty((n, d), dtype=self.dtype)
+        self.weights = np.full(n, 1.0 / n, dtype=self.dtype)
+        self.original_weights = np.empty(n, dtype=self.dtype)
+        self.mean_state = np.zeros(d, dtype=self.dtype)
+        self.n_eff = 1.0
+        self._arange = np.arange(n, dtype=np.float64)
+        self._positions = np.empty(n, dtype=np.float64)
+        self._cumsum = np.empty(n, dtype=np.float64)
+        self._uniform = np.empty(n, dtype=np.float64)
+        self._mask = np.empty(n, dtype=bool)
+        # readers see the new particles straight away, not only after update()
+        np.copyto(self.original_particles, self._front)
+        np.copyto(self.original_weights, self.weights)
+        np.dot(self.weights, self._front, out=self.mean_state)
+
+    @property
+    def particles(self):
+        return self._front
+
+    def _apply(self, fn):
+        result = fn(self._front)
+        if result is not self._front:
+            np.copyto(self._front, result, casting="unsafe")
+
+    def update(self, observed=None):
+        """Update the filter given an observation (or None to only predict)"""
+        n = self.n_particles
+        self._apply(self.dynamics_fn)
+        self._apply(self.noise_fn)
+        self.hypotheses = self.observe_fn(self._front)
+
+        if observed is not None:
+            observed = np.asarray(observed, dtype=np.float64).reshape(1, -1)
+            similarity = self.weight_fn(self.hypotheses.reshape(n, -1), observed)
+            np.multiply(self.weights, similarity, out=self.weights, casting="unsafe")
+            np.clip(self.weights, 0, np.inf, out=self.weights)
+
+        total = np.sum(self.weights)
+        if total > 0:
+            self.weights /= total
+        else:
+            self.weights.fill(1.0 / n)
+        self.n_eff = (1.0 / np.dot(self.weights, self.weights)) / n
+
+        np.copyto(self.original_particles, self._front)
+        np.copyto(self.original_weights, self.weights)
+        np.dot(self.weights, self._front, out=self.mean_state)
+
+        if self.n_eff < self.n_eff_threshold:
+            self._resample()
+
+        if self.resample_proportion > 0:
+            self.rng.random(out=self._uniform)
+            np.less(self._uniform, self.resample_proportion, out=self._mask)
+            k = np.count_nonzero(self._mask)
+            if k:
+                self._front[self._mask] = self.prior_fn(k)
+
+    def _resample(self):
+        n = self.n_particles
+        # positions are ((0..n-1) + u) / n, with one u (systematic) or one per particle (stratified)
+        if self.stratified:
+            self.rng.random(out=self._positions)
+            self._positions += self._arange
+        else:
+            np.add(self._arange, self.rng.random(), out=self._positions)
+        self._positions /= n
+        np.cumsum(self.weights, out=self._cumsum)
+        self._cumsum[-1] = 1.0
+        indices = np.searchsorted(self._cumsum, self._positions)
+        np.take(self._front, indices, axis=0, out=self._back)
+        self._front, self._back = self._back, self._front
+        self.weights.fill(1.0 / n)
+
+
+def estimate_swipe(particles):
+    """Probability of a left/right/no swipe from the fraction of particles
+    that have completed the gesture. Works on an (N,D) particle array, or
+    an (S,N,D) array from BatchParticleFilter, in which case each
+    probability is an S-element array."""
+    terminated = particles[..., 1] > 0.5
+    left = np.mean(terminated & (particles[..., 0] < 0), axis=-1)
+    right = np.mean(terminated & (particles[..., 0] > 0), axis=-1)
+    return {"left": left, "right": right, "no": 1.0 - (left + right)}
+
+
+def trigger_action(swipe, p_threshold=0.75):
+    """Trigger on crossing a probability threshold. Returns "left", "right"
+    or "no", or an array of them for per-stream probabilities."""
+    action = np.where(swipe["left"] > p_threshold, "left",
+                      np.where(swipe["right"] > p_threshold, "right", "no"))
+    return str(action) if action.ndim == 0 else action
+
+
+def resize_filter(pf, n):
+    """Resample a filter's particle set to n equally weighted particles"""
+    if hasattr(pf, "resize"):
+        pf.resize(n)
+        return
+    indices = systematic_resample(pf.weights, n)
+    pf.particles = pf.particles[indices]
+    pf.weights = np.full(n, 1.0 / n)
+    pf.n_particles = n
+
+
+class AdaptiveParticles:
+    """Chooses the particle count for each update from the effective sample
+    size, without letting an update exceed `budget` seconds.
+
+    The particle set grows by `step` when the normalised ESS (pf.n_eff)
+    falls below `low` and shrinks when it is above `high`. The cost per
+    particle is tracked from the measured update times, and the count is
+    capped at what the budget can afford.
+    """
+    def __init__(self, budget=0.025, min_particles=50, max_particles=5000,
+                 low=0.3, high=0.8, step=1.5, smoothing=0.8):
+        self.budget = budget
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.low = low
+        self.high = high
+        self.step = step
+        self.smoothing = smoothing
+        self.cost = None
+
+    def choose(self, n, n_eff, elapsed, observed=True):
+        """Return the particle count to use next, given the current count,
+        normalised ESS and the time the last update took. The ESS is only
+        meaningful after an observation, so if `observed` is False only the
+        budget is enforced."""
+        cost = elapsed / n
+        self.cost = cost if self.cost is None else self.smoothing * self.cost + (1 - self.smoothing) * cost
+        if observed and n_eff < self.low:
+            n = n * self.step
+        elif observed and n_eff > self.high:
+            n = n / self.step
+        affordable = self.budget / self.cost
+        return int(np.clip(min(n, affordable), self.min_particles, self.max_particles))
+
+    def update(self, pf, elapsed, observed=True):
+        """Resize pf if needed after an update that took `elapsed` seconds"""
+        n = self.choose(pf.n_particles, pf.n_eff, elapsed, observed)
+        if n != pf.n_particles:
+            resize_filter(pf, n)
+        return n
+
+
+Snapshot = namedtuple("Snapshot", ["tick", "particles", "weights", "probs", "action"])
+
+
+class RateMeter:
+    """Smoothed estimate of how often tick() is being called, in Hz"""
+    def __init__(self, smoothing=0.9):
+        self.smoothing = smoothing
+        self.rate = 0.0
+        self.last = None
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.last is not None and now > self.last:
+            rate = 1.0 / (now - self.last)
+            if self.rate == 0.0:
+                self.rate = rate
+            else:
+                self.rate = self.smoothing * self.rate + (1 - self.smoothing) * rate
+        self.last = now
+
+
 class FilterCanvas:
-    def __init__(self, pf, observing=False, estimator=None, trigger=None, predict=False):        
+    """Runs a particle filter live against mouse input, and draws it.
+
+    Inference runs on its own thread at a fixed `rate` (Hz), publishing a
+    Snapshot after each update into a bounded ring buffer. A separate
+    render thread draws the most recent snapshot at up to `fps` frames per
+    second; if drawing falls behind, intermediate snapshots are dropped,
+    so slow drawing never slows down the filter or the trigger. Snapshots
+    evicted from a full buffer count as dropped too, and the latest fired
+    action is kept outside the buffer so it is always shown.
+    """
+    def __init__(self, pf, observing=False, estimator=None, trigger=None, predict=False,
+                 rate=20, fps=20, buffer_size=8, adaptive=None):
         self.out = Output()
         self.pf = pf
         self.canvas = Canvas(width=800, height=500)                
@@ -23,6 +363,19 @@ class FilterCanvas:
         self.trigger_state = 0
         self.trigger_text = ""
         self.predict = predict
+        self.rate = rate
+        self.fps = fps
+        self.snapshots = deque(maxlen=buffer_size)
+        self.snapshot_lock = Lock()
+        self.fired_action = "no"
+        self.inference_rate = RateMeter()
+        self.render_rate = RateMeter()
+        self.dropped_frames = 0
+        self.inference_done = Event()
+        self.trace = []
+        # optional AdaptiveParticles controller
+        self.adaptive = adaptive
+        self.filter_status = ""
         self.stopping.clear()
         
 
@@ -31,6 +384,7 @@ class FilterCanvas:
         
     def start(self):
         Thread(target=self.simulate).start()
+        Thread(target=self.render).start()
         
     def handle_mouse_move(self, x, y):        
         if self.stopping.is_set() or not self.observing:
@@ -46,12 +400,12 @@ class FilterCanvas:
         x = particles[:,1] * sign * self.canvas.width/ 2.5 + self.canvas.width/2                
         self.canvas.fill_circles(x, y, 3)
 
-    def draw_prediction(self, filter, y):        
-        pf_copy = filter.copy()
-        for i in range(10):
-            pf_copy.update()
-            pf_copy.update()
-            self.draw_particles(pf_copy.particles, pf_copy.weights, y, color=f"#9060d010")
+    def draw_prediction(self, particles, weights, y, horizon=10):        
+        ensemble = forecast(particles, self.pf.dynamics_fn, horizon, noise_fn=self.pf.noise_fn,
+                            weights=weights, steps=2)
+        # draw every forecast step in a single call
+        self.draw_particles(ensemble.reshape(-1, ensemble.shape[-1]), None, np.tile(y, horizon),
+                            color=f"#9060d010")
 
         
         
@@ -80,44 +434,103 @@ class FilterCanvas:
             self.canvas.fill_text(self.trigger_text, self.canvas.width/2, self.canvas.height/2)
 
     def simulate(self):
-        y_pos = 0
+        """Inference loop: update the filter at a fixed rate and publish
+        snapshots for the renderer"""
+        period = 1.0 / self.rate
+        next_tick = time.perf_counter()
         for i in range(1000):            
             if self.stopping.is_set():
                 break
-            with hold_canvas():
-                particles = self.pf.original_particles
-                
-                if not self.observing:
-                    y = np.full(len(particles), y_pos) + y_pos
-                    self.draw_particles(particles, self.pf.original_weights, y)
-                    y_pos += 2
-                else:
-
-                    y = np.random.normal(self.canvas.height/2, 10, len(particles))
-                    self.canvas.clear()                
-
-                    if self.estimator:                                        
-                        # show bar chart
-                        probs = self.estimator(particles)                    
-                        self.draw_estimator(probs)
-                    
-                        # show triggered actions
-                        if self.trigger:
-                            action = self.trigger(probs)
-                            self.draw_trigger(action)
-                    
-                    self.draw_particles(particles, self.pf.original_weights, y)   
-                    # show predictions, if enabled
-                    if self.predict:
-                        self.draw_prediction(self.pf, y)             
-
-                if self.observing and self.mouse_x is not None:
-                    self.pf.update(np.array([self.mouse_x]))
+            with self.world_lock:
+                mouse_x, self.mouse_x = self.mouse_x, None
+                # record the observation stream so it can be replayed headless
+                self.trace.append(np.nan if mouse_x is None else mouse_x)
+                update_start = time.perf_counter()
+                if self.observing and mouse_x is not None:
+                    self.pf.update(np.array([mouse_x]))
                 else:
                     self.pf.update() 
-                self.mouse_x = None
-                time.sleep(0.05)
-          
+                particles = np.array(self.pf.original_particles)
+                weights = np.array(self.pf.original_weights)
+                if self.adaptive:
+                    n_eff = self.pf.n_eff
+                    n = self.adaptive.update(self.pf, time.perf_counter() - update_start,
+                                             observed=self.observing and mouse_x is not None)
+                    self.filter_status = f" | {n} particles, ESS {n_eff:.2f}"
+
+            probs, action = None, "no"
+            if self.observing and self.estimator:
+                probs = self.estimator(particles)
+                if self.trigger:
+                    action = self.trigger(probs)
+
+            with self.snapshot_lock:
+                # a full buffer evicts its oldest snapshot, which is never drawn
+                if len(self.snapshots) == self.snapshots.maxlen:
+                    self.dropped_frames += 1
+                self.snapshots.append(Snapshot(i, particles, weights, probs, action))
+                if action != "no":
+                    self.fired_action = action
+            self.inference_rate.tick()
+
+            # sleep until the next tick; if we have overrun, don't try to catch up
+            next_tick += period
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.perf_counter()
+        self.inference_done.set()
+
+    def render(self):
+        """Render loop: draw the latest snapshot, dropping any that were
+        published since the last frame"""
+        period = 1.0 / self.fps
+        while not (self.stopping.is_set() or (self.inference_done.is_set() and not self.snapshots)):
+            frame_start = time.perf_counter()
+            with self.snapshot_lock:
+                pending = list(self.snapshots)
+                self.snapshots.clear()
+                action, self.fired_action = self.fired_action, "no"
+                # all but the latest are skipped (trace mode draws them all)
+                if self.observing and pending:
+                    self.dropped_frames += len(pending) - 1
+            if pending:
+                self.draw_snapshots(pending, action)
+                self.render_rate.tick()
+                self.label.value = (f"inference {self.inference_rate.rate:.0f} Hz | "
+                                    f"render {self.render_rate.rate:.0f} fps | "
+                                    f"dropped {self.dropped_frames} frames"
+                                    f"{self.filter_status}")
+            delay = period - (time.perf_counter() - frame_start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def draw_snapshots(self, pending, action="no"):
+        with hold_canvas():
+            if not self.observing:
+                # trace mode: every snapshot gets its own row, so draw them all
+                for snap in pending:
+                    y = np.full(len(snap.particles), snap.tick * 4.0)
+                    self.draw_particles(snap.particles, snap.weights, y)
+                return
+
+            snap = pending[-1]
+            y = np.random.normal(self.canvas.height/2, 10, len(snap.particles))
+            self.canvas.clear()                
+
+            if snap.probs is not None:
+                # show bar chart
+                self.draw_estimator(snap.probs)
+                # show triggered actions, including any fired in dropped frames
+                if self.trigger:
+                    self.draw_trigger(action)
+
+            self.draw_particles(snap.particles, snap.weights, y)   
+            # show predictions, if enabled
+            if self.predict:
+                self.draw_prediction(snap.particles, snap.weights, y)             
+
     def draw(self):
         display(self.label)
         display(self.stop)
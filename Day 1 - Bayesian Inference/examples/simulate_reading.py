@@ -1,18 +1,23 @@
+import os
+import mmap
+import shutil
+import tempfile
+import codecs
+import hashlib
 import numpy as np
+import scipy.stats
 
 import re
+from functools import lru_cache
 
-# syllable count from https://stackoverflow.com/questions/46759492/syllable-count-in-python
-def sylco(word):
-    word = word.lower()
-
-    # exception_add are words that need extra syllables
-    # exception_del are words that need less syllables
+# exception_add are words that need extra syllables
+# exception_del are words that need less syllables
 
-    exception_add = ["serious", "crucial"]
-    exception_del = ["fortunately", "unfortunately"]
+exception_add = frozenset(["serious", "crucial"])
+exception_del = frozenset(["fortunately", "unfortunately"])
 
-    co_one = [
+co_one = frozenset(
+    [
         "cool",
         "coach",
         "coat",
@@ -28,9 +33,42 @@ def sylco(word):
         "coof",
         "court",
     ]
-    co_two = ["coapt", "coed", "coinci"]
+)
+co_two = frozenset(["coapt", "coed", "coinci"])
+
+pre_one = frozenset(["preach"])
+
+le_except = frozenset(
+    [
+        "whole",
+        "mobile",
+        "pole",
+        "male",
+        "female",
+        "hale",
+        "pale",
+        "tale",
+        "sale",
+        "aisle",
+        "whale",
+        "while",
+    ]
+)
+
+negative = frozenset(["doesn't", "isn't", "shouldn't", "couldn't", "wouldn't"])
+
+# patterns are compiled once, rather than on every word
+vowel_re = re.compile(r"[eaoui]")
+vowel_pair_re = re.compile(r"[eaoui][eaoui]")
+vowel_triple_re = re.compile(r"[eaoui][eaoui][eaoui]")
+vowel_consonant_re = re.compile(r"[eaoui][^eaoui]")
 
-    pre_one = ["preach"]
+
+# syllable count from https://stackoverflow.com/questions/46759492/syllable-count-in-python
+# memoised, as running text repeats the same words over and over
+@lru_cache(maxsize=None)
+def sylco(word):
+    word = word.lower()
 
     syls = 0  # added syllable number
     disc = 0  # discarded syllable number
@@ -44,8 +82,8 @@ def sylco(word):
     # if it has only 1 vowel or 1 set of consecutive vowels, discard. (like "speed", "fled" etc.)
 
     if word[-2:] == "es" or word[-2:] == "ed":
-        doubleAndtripple_1 = len(re.findall(r"[eaoui][eaoui]", word))
-        if doubleAndtripple_1 > 1 or len(re.findall(r"[eaoui][^eaoui]", word)) > 1:
+        doubleAndtripple_1 = len(vowel_pair_re.findall(word))
+        if doubleAndtripple_1 > 1 or len(vowel_consonant_re.findall(word)) > 1:
             if (
                 word[-3:] == "ted"
                 or word[-3:] == "tes"
@@ -59,21 +97,6 @@ def sylco(word):
 
     # 3) discard trailing "e", except where ending is "le"
 
-    le_except = [
-        "whole",
-        "mobile",
-        "pole",
-        "male",
-        "female",
-        "hale",
-        "pale",
-        "tale",
-        "sale",
-        "aisle",
-        "whale",
-        "while",
-    ]
-
     if word[-1:] == "e":
         if word[-2:] == "le" and word not in le_except:
             pass
@@ -83,12 +106,12 @@ def sylco(word):
 
     # 4) check if consecutive vowels exists, triplets or pairs, count them as one.
 
-    doubleAndtripple = len(re.findall(r"[eaoui][eaoui]", word))
-    tripple = len(re.findall(r"[eaoui][eaoui][eaoui]", word))
+    doubleAndtripple = len(vowel_pair_re.findall(word))
+    tripple = len(vowel_triple_re.findall(word))
     disc += doubleAndtripple + tripple
 
     # 5) count remaining vowels in word.
-    numVowels = len(re.findall(r"[eaoui]", word))
+    numVowels = len(vowel_re.findall(word))
 
     # 6) add one if starts with "mc"
     if word[:2] == "mc":
@@ -144,8 +167,6 @@ def sylco(word):
 
     # 13) check for "-n't" and cross match with dictionary to add syllable.
 
-    negative = ["doesn't", "isn't", "shouldn't", "couldn't", "wouldn't"]
-
     if word[-3:] == "n't":
         if word in negative:
             syls += 1
@@ -164,34 +185,302 @@ def sylco(word):
     return numVowels - disc + syls
 
 
+def syllables(words):
+    """Syllable counts for a sequence of words, as an integer array. Each
+    distinct word is only counted once."""
+    return np.fromiter((sylco(word) for word in words), dtype=np.int64, count=len(words))
+
+
+def pauses(words):
+    """Extra pause per word, in units of the reader's k: one for a comma,
+    one for a colon or semicolon, and three for a word starting with
+    ".!?" (the pattern read_text has always used)."""
+    return np.fromiter(
+        (
+            ("," in word) + 3 * word.startswith(".!?") + (";" in word or ":" in word)
+            for word in words
+        ),
+        dtype=np.int64,
+        count=len(words),
+    )
+
+
+split_re = re.compile(r"\s")
+
+
+class Corpus:
+    """A pre-tokenised text: the character offset of every token (split on
+    single whitespace characters, exactly as read_text splits), with its
+    syllable count and pause, as arrays.
+
+    Use Corpus.load(path) to build it once and cache it next to the text,
+    in a directory keyed by the file's hash, as .npy files which later
+    sessions memory-map instead of re-reading and re-counting the text.
+    `portion(p)` is a zero-copy view of the first fraction p of the text.
+    read_text, word_count and read_text_batch accept a Corpus anywhere
+    they accept a string.
+    """
+
+    fields = ("starts", "syls", "pauses")
+
+    def __init__(self, starts, syls, pauses, n_chars, path=None):
+        self.starts = starts
+        self.syls = syls
+        self.pauses = pauses
+        self.n_chars = n_chars
+        self.path = path
+
+    @classmethod
+    def from_text(cls, text, path=None):
+        words = split_re.split(text)
+        lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        # each token is followed by exactly one whitespace character
+        starts = np.concatenate([[0], np.cumsum(lengths[:-1] + 1)])
+        return cls(starts, syllables(words).astype(np.int16), pauses(words).astype(np.int8),
+                   len(text), path)
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        """Load the corpus for a text file, building the cache if needed"""
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), ".corpus_cache")
+        bundle = os.path.join(cache_dir, digest)
+        try:
+            arrays = [np.load(os.path.join(bundle, f"{name}.npy"), mmap_mode="r") for name in cls.fields]
+            n_chars = int(np.load(os.path.join(bundle, "n_chars.npy")))
+            return cls(*arrays, n_chars, path)
+        except (OSError, ValueError):
+            pass
+        corpus = cls.from_text(raw.decode("utf8"), path)
+        # build the bundle under a temporary name and rename it into place,
+        # so other processes (which may have it memory-mapped) never see
+        # a partly written bundle; if one beat us to it, keep theirs
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=f".{digest}-", dir=cache_dir)
+        try:
+            for name in cls.fields:
+                np.save(os.path.join(tmp, f"{name}.npy"), getattr(corpus, name))
+            np.save(os.path.join(tmp, "n_chars.npy"), corpus.n_chars)
+            try:
+                os.rename(tmp, bundle)
+            except OSError:
+                if not os.path.isdir(bundle):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return corpus
+
+    def __len__(self):
+        return len(self.starts)
+
+    def portion(self, p):
+        """The corpus for text[:int(len(text) * p)], as views of these arrays.
+        A token cut in half by the boundary keeps the counts of the whole
+        token."""
+        n_chars = int(self.n_chars * p)
+        # tokens of the prefix are exactly those that start at or before its end
+        n = max(int(np.searchsorted(self.starts, n_chars, side="right")), 1)
+        return Corpus(self.starts[:n], self.syls[:n], self.pauses[:n], n_chars, self.path)
+
+
+def _features(text):
+    """Syllables, pauses and character length of a string or Corpus"""
+    if isinstance(text, Corpus):
+        # keep the stored dtypes: casting would copy a memory-mapped corpus
+        return text.syls, text.pauses, text.n_chars
+    words = split_re.split(text)
+    return syllables(words), pauses(words), len(text)
+
+
 def word_count(text):
-    words = re.split("\s", text)
+    if isinstance(text, Corpus):
+        return len(text)
+    words = split_re.split(text)
     return len(words)
 
 
-def read_text(text, font_size=12, base_wpm=250):
-    words = re.split("\s", text)
+def reader_k(font_size=12, base_wpm=250, rng=None):
+    """Draw a reader's time constant k (seconds) for a font size"""
+    rng = np.random.default_rng(rng)
+    k = 60.0 / base_wpm
+    k = k + 0.01 * (font_size - 10) ** 2 + 0.08 * (1 / font_size)
+    return rng.normal(k, k / 4)
+
+
+def read_words(syls, pause, k, rng=None):
+    """Total time to read words with the given syllable counts and pauses,
+    for a reader with time constant k. All noise is drawn in bulk."""
+    rng = np.random.default_rng(rng)
+    n = len(syls)
+    time = np.sum(np.abs(rng.normal((k / 2) * np.square(syls, dtype=np.float64), k * 2))) + n * k / 4
+    time += k * np.sum(pause)
+    # sometimes we get distracted: each word has a 0.5% chance of an
+    # exponential(60s) distraction, and a sum of those is a gamma
+    distractions = rng.binomial(n, 0.005)
+    if distractions:
+        time += rng.gamma(distractions, 60.0)
+    return time
+
+
+def word_durations(syls, pause, k, rng=None):
+    """Seconds spent on each word, as an array: the per-word terms of
+    read_words, including distractions"""
+    rng = np.random.default_rng(rng)
+    n = len(syls)
+    times = np.abs(rng.normal((k / 2) * np.square(syls, dtype=np.float64), k * 2)) + k / 4 + k * pause
+    distracted = rng.random(n) < 0.005
+    times[distracted] += rng.exponential(60.0, np.count_nonzero(distracted))
+    return times
+
+
+def read_pages(path, font_size=12, base_wpm=250, rng=None, chunk_size=1 << 20, word_times=False):
+    """Stream the reading of a (utf8) text file page by page.
+
+    The file is memory-mapped and decoded chunk_size bytes at a time, so
+    memory use is bounded by the chunk and page size, however long the
+    book. Pages are font-size dependent runs of characters, as in
+    read_text, and a word belongs to the page it starts on. Yields one
+    dictionary per page:
+
+        page, first_word, n_words: position of the page in the book
+        read_time: seconds spent reading the page's words
+        turn_time: seconds turning to the next page (0 for the last page)
+        elapsed: total seconds from the start of the book to the end of
+            this page, including turns
+        word_times: per-word durations (only if word_times is True)
+
+    Summed over pages, the time has the same distribution as read_text.
+    """
+    rng = np.random.default_rng(rng)
+    page_size = 1000 * (10 / font_size)
+    page_time = 3
+    k = reader_k(font_size, base_wpm, rng)
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            decoder = codecs.getincrementaldecoder("utf8")()
+            pending = ""  # a token that may continue into the next chunk
+            offset = 0  # character offset of the start of pending
+            page, first_word, elapsed = 0, 0, 0.0
+            page_times = []
+
+            def finish_page(turn):
+                nonlocal page, first_word, elapsed, page_times
+                times = np.concatenate(page_times) if page_times else np.zeros(0)
+                read_time = float(np.sum(times))
+                turn_time = page_time if turn else 0
+                elapsed += read_time + turn_time
+                record = {"page": page, "first_word": first_word, "n_words": len(times),
+                          "read_time": read_time, "turn_time": turn_time, "elapsed": elapsed}
+                if word_times:
+                    record["word_times"] = times
+                page += 1
+                first_word += len(times)
+                page_times = []
+                return record
+
+            for pos in range(0, size, chunk_size):
+                final = pos + chunk_size >= size
+                text = pending + decoder.decode(mm[pos : pos + chunk_size], final=final)
+                words = split_re.split(text)
+                pending = "" if final else words.pop()
+                if not words:
+                    continue
+                lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+                starts = offset + np.concatenate([[0], np.cumsum(lengths[:-1] + 1)])
+                offset += int(np.sum(lengths)) + len(words)
+                times = word_durations(syllables(words), pauses(words), k, rng)
+                pages = (starts // page_size).astype(np.int64)
+
+                # split this chunk's words at page boundaries
+                bounds = np.flatnonzero(np.diff(pages)) + 1
+                for chunk_pages, chunk_times in zip(np.split(pages, bounds), np.split(times, bounds)):
+                    while page < chunk_pages[0]:
+                        yield finish_page(turn=True)
+                    page_times.append(chunk_times)
+
+            # the text is offset - 1 characters long (no whitespace after the last token)
+            n_pages = max(page + 1, int((offset - 1) / page_size))
+            while page < n_pages:
+                yield finish_page(turn=(page + 1) * page_size <= offset - 1)
+
+
+def read_text(text, font_size=12, base_wpm=250, rng=None):
+    """Simulated seconds to read text (a string or Corpus). rng is a seed or
+    np.random.Generator."""
+    rng = np.random.default_rng(rng)
+    syls, pause, n_chars = _features(text)
     page_size = 1000 * (10 / font_size)
     page_time = 3
 
-    time = 0
-    k = 60.0 / base_wpm
-    k = k + 0.01 * (font_size - 10) ** 2 + 0.08 * (1 / font_size)
-    k = np.random.normal(k, k/4)
-    times = []
-    for word in words:
-        syls = sylco(word)
-        time += np.abs(np.random.normal((k / 2) * syls**2, k*2)) + k / 4
-        if "," in word:
-            time += k
-        if re.match("\\.!\?", word):
-            time += k * 3
-        if ";" in word or ":" in word:
-            time += k
-        # sometimes we get distracted
-        if np.random.uniform(0, 1) < 0.005:
-            time += np.random.exponential(60.0)
-        times.append(time)
-
-    time += int(len(text) / page_size) * page_time
+    k = reader_k(font_size, base_wpm, rng)
+    time = read_words(syls, pause, k, rng)
+    time += int(n_chars / page_size) * page_time
+    return time
+
+
+def folded_noise_moments(syls):
+    """Mean and variance of the sum over words of |N(s^2/2, 2^2)|, the
+    per-word reading noise in units of k"""
+    mu = syls.astype(np.float64) ** 2 / 2
+    sigma = 2.0
+    mean = sigma * np.sqrt(2 / np.pi) * np.exp(-(mu**2) / (2 * sigma**2)) + mu * (
+        1 - 2 * scipy.stats.norm.cdf(-mu / sigma)
+    )
+    var = mu**2 + sigma**2 - mean**2
+    return np.sum(mean), np.sum(var)
+
+
+def read_text_batch(text, font_sizes, base_wpm=250, n_readers=None, reader_z=None, rng=None,
+                    max_draws=10**7):
+    """Simulated reading times for every combination of font size and
+    reader, as a (len(font_sizes), n_readers) array, from one pass over the
+    text.
+
+    Each reader j has a standard normal offset reader_z[j] (drawn if not
+    given), and their k at font size i is k0(i, j) * (1 + reader_z[j] / 4):
+    the same N(k0, k0/4) draw read_text makes per call, but held fixed for
+    a reader across font sizes. base_wpm is a scalar or one value per
+    reader.
+
+    The per-word noise scales with k, so it is simulated once per cell.
+    If that would take more than max_draws normal draws, its sum is drawn
+    from a normal with the exact mean and variance instead. With that
+    many words the sum is normal to within sampling error.
+    """
+    rng = np.random.default_rng(rng)
+    syls, pause, n_chars = _features(text)
+    total_pause = np.sum(pause)
+    n = len(syls)
+
+    font_sizes = np.asarray(font_sizes, dtype=np.float64)[:, None]
+    base_wpm = np.atleast_1d(np.asarray(base_wpm, dtype=np.float64))
+    if reader_z is None:
+        n_readers = n_readers or len(base_wpm)
+        reader_z = rng.normal(0, 1, n_readers)
+    reader_z = np.asarray(reader_z, dtype=np.float64)
+    shape = np.broadcast_shapes((len(font_sizes), 1), base_wpm.shape, reader_z.shape)
+
+    k = 60.0 / base_wpm + 0.01 * (font_sizes - 10) ** 2 + 0.08 * (1 / font_sizes)
+    k = np.broadcast_to(k * (1 + reader_z / 4), shape)
+
+    if n * k.size <= max_draws:
+        mu = np.square(syls, dtype=np.float64) / 2
+        noise = np.array([np.sum(np.abs(rng.normal(mu, 2.0))) for _ in range(k.size)])
+    else:
+        mean, var = folded_noise_moments(syls)
+        noise = rng.normal(mean, np.sqrt(var), k.size)
+    time = k * (noise.reshape(shape) + n / 4 + total_pause)
+
+    distractions = rng.binomial(n, 0.005, shape)
+    time = time + rng.gamma(np.maximum(distractions, 1), 60.0) * (distractions > 0)
+
+    page_size = 1000 * (10 / font_sizes)
+    page_time = 3
+    time = time + (n_chars // page_size) * page_time
     return time
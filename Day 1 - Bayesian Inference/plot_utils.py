@@ -2,12 +2,96 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from collections import OrderedDict
+
+
+class PMF:
+    """A PMF stored as arrays of outcomes and probabilities.
+
+    It has the keys/values/items of a dict PMF, so it can be passed anywhere
+    a dict can. The alias table used by `sample` and the CDF used by
+    `quantile` are built on first use and cached.
+    """
+    def __init__(self, outcomes, probs):
+        self.outcomes = np.asarray(outcomes)
+        probs = np.asarray(probs, dtype=float)
+        self.probs = probs / np.sum(probs)
+        self._alias = None
+        self._cdf = None
+
+    @classmethod
+    def from_dict(cls, pmf):
+        return cls(list(pmf.keys()), list(pmf.values()))
+
+    def keys(self):
+        return self.outcomes
+
+    def values(self):
+        return self.probs
+
+    def items(self):
+        return zip(self.outcomes, self.probs)
+
+    def __len__(self):
+        return len(self.probs)
+
+    def alias_table(self):
+        """Vose's alias table: (probability of keeping each column, alias)"""
+        if self._alias is None:
+            n = len(self.probs)
+            scaled = self.probs * n
+            keep, alias = np.ones(n), np.arange(n)
+            small = list(np.flatnonzero(scaled < 1))
+            large = list(np.flatnonzero(scaled >= 1))
+            while small and large:
+                s, l = small.pop(), large.pop()
+                keep[s], alias[s] = scaled[s], l
+                scaled[l] -= 1 - scaled[s]
+                (small if scaled[l] < 1 else large).append(l)
+            self._alias = keep, alias
+        return self._alias
+
+    def sample(self, n=1, rng=None):
+        """n outcomes, drawn in O(1) each from the alias table"""
+        rng = np.random if rng is None else rng
+        keep, alias = self.alias_table()
+        u = rng.random(n) * len(keep)
+        column = u.astype(int)
+        return self.outcomes[np.where(u - column < keep[column], column, alias[column])]
+
+    def cdf(self):
+        """The outcomes in sorted order, and the CDF at each of them"""
+        if self._cdf is None:
+            order = np.argsort(self.outcomes, kind="stable")
+            self._cdf = self.outcomes[order], np.cumsum(self.probs[order])
+        return self._cdf
+
+    def quantile(self, q):
+        """The smallest outcome(s) whose CDF is at least q"""
+        outcomes, cdf = self.cdf()
+        return outcomes[np.minimum(np.searchsorted(cdf, q), len(cdf) - 1)]
+
+    def expectation(self, g=None):
+        if g is None:
+            return self.outcomes @ self.probs
+        try:
+            values = np.asarray(g(self.outcomes), dtype=float)
+        except (TypeError, ValueError, KeyError, IndexError):
+            values = None
+        # g doesn't work elementwise on arrays, so apply it to each outcome
+        if values is None or values.shape != self.outcomes.shape:
+            values = np.array([g(outcome) for outcome in self.outcomes], dtype=float)
+        return values @ self.probs
 
 
 def sample(pmf, n=1):
+    if isinstance(pmf, PMF):
+        return list(pmf.sample(n))
     return list(np.random.choice(list(pmf.keys()), p=list(pmf.values()), size=n))
 
 def expectation(pmf, g=lambda x: x):
+    if isinstance(pmf, PMF):
+        return pmf.expectation(g)
     return sum(g(outcome) * p for outcome, p in pmf.items())
 
 def show_grid(pmf, ax = None):
@@ -32,6 +116,35 @@ def show_grid(pmf, ax = None):
 def to_samples(products, n=150):
     return {product:sample(pmf, n) for product, pmf in products.items()}
 
+
+_products_cache = OrderedDict()
+
+
+def products_key(products):
+    """A key that changes whenever any of the products' PMFs does"""
+    return tuple((name, id(pmf) if isinstance(pmf, PMF) else hash(tuple(pmf.items())))
+                 for name, pmf in products.items())
+
+
+def cached_products(products, maxsize=16):
+    """products as {name: PMF}, and a {n: samples} dict shared by all the
+    show_products_* views, memoised on the products' PMFs"""
+    key = products_key(products)
+    if key not in _products_cache:
+        pmfs = {name: pmf if isinstance(pmf, PMF) else PMF.from_dict(pmf) for name, pmf in products.items()}
+        _products_cache[key] = (pmfs, {})
+        if len(_products_cache) > maxsize:
+            _products_cache.popitem(last=False)
+    return _products_cache[key]
+
+
+def cached_samples(products, n=150):
+    """to_samples(products, n), drawn once for each distinct products"""
+    pmfs, samples = cached_products(products)
+    if n not in samples:
+        samples[n] = to_samples(pmfs, n)
+    return samples[n]
+
 def rotate_labels():
     ax = plt.gca()
     ax.set_xticklabels(ax.get_xticklabels(),rotation = 45)
@@ -40,7 +153,8 @@ def rotate_labels():
 
 def show_products_mean(products):
     fig, ax = plt.subplots()    
-    ax.scatter(np.arange(len(products)), [expectation(v) for v in products.values()])
+    pmfs, _ = cached_products(products)
+    ax.scatter(np.arange(len(products)), [pmf.expectation() for pmf in pmfs.values()])
     ax.set_xticks(np.arange(len(products)))
     ax.set_xticklabels(products.keys())
     ax.set_ylabel("q")
@@ -49,7 +163,7 @@ def show_products_mean(products):
     
 def show_products_box(products):
     fig, ax = plt.subplots()
-    samps = to_samples(products)
+    samps = cached_samples(products)
     ax.boxplot(samps.values(), labels=samps.keys())
     ax.set_title("Box plot")
     ax.set_ylabel("q")
@@ -57,7 +171,7 @@ def show_products_box(products):
 
 def show_products_violin(products):
     fig, ax = plt.subplots()
-    samps = to_samples(products)
+    samps = cached_samples(products)
     sns.violinplot(data=list(samps.values()), scale="width")
     ax.set_xticklabels(samps.keys())    
     ax.set_ylabel("q")
@@ -66,7 +180,7 @@ def show_products_violin(products):
 
 def show_products_swarm(products):
     fig, ax = plt.subplots()
-    samps = to_samples(products)
+    samps = cached_samples(products)
     data = np.array(list(samps.values())) 
     data += np.random.normal(0,0.05,data.shape)
     
@@ -82,9 +196,9 @@ def show_products_strip(products):
     x = 0
     ax.set_xlim(-0.1,len(products)/5)
     ax.set_ylim(0,1)
-    for product, pmf in products.items():
-        xs = np.array(list(pmf.keys()))
-        cs = np.sqrt(np.array(list(pmf.values())))
+    pmfs, _ = cached_products(products)
+    for product, pmf in pmfs.items():
+        cs = np.sqrt(pmf.probs)
         ax.imshow(np.tile(cs[None, :], (8, 1)).T, cmap='magma', vmin=0, vmax=1, 
                    extent=[x, x+0.1, 0, 1], origin='lower')  
         ax.text(x, -0.3, product, rotation=45, ha='center')        
@@ -96,8 +210,7 @@ def show_products_strip(products):
     
 def show_products_table(products):
     rows = []
-    sampled = to_samples(products)
-    for food, samples in sampled.items():        
-        row = [food, np.percentile(samples, 0.25), np.percentile(samples, 0.5), np.percentile(samples, 0.75)]
-        rows.append(row)
+    pmfs, _ = cached_products(products)
+    for food, pmf in pmfs.items():
+        rows.append([food, *pmf.quantile([0.25, 0.5, 0.75])])
     return pd.DataFrame(rows, columns=["name", "Q1", "Median", "Q3"])
\ No newline at end of file
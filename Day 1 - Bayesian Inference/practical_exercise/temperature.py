@@ -12,24 +12,122 @@ from IPython.display import display
 # min, max, relative density
 meat_temps = {"salmon":(49,60,0.7) , "steak":(55, 70,1.1), "shrimp":(61, 64,0.6), "chicken":(71, 90,1.0), "pork":(71, 85,1.1), "boar":(76, 81,1.2)}
 init_temps = {"room temperature":20, "chilled":4, "frozen":-27}
+meat_names = list(meat_temps.keys())
+chill_names = list(init_temps.keys())
 
 
 def optimal_temps(meat):
     mn, mx, density = meat_temps[meat]
-    temps = np.linspace(30, 100, 200)
-    utility = meat_utility(temps, mn, mx)
-    best = temps[np.argmax(utility)]
+    best = table_temps[np.argmax(utility_table[meat_names.index(meat)])]
     undercooked = mn 
     overcooked = mx 
     return undercooked, best, overcooked
 
 
 def expectation_cookedness(temps, meat):
-    mn, mx, density = meat_temps[meat]
-    return np.mean([meat_utility(t, mn, mx) for t in temps])
+    return np.mean(utility_lookup(temps, meat))
     
-from threading import Thread, Event, Lock 
+from threading import Thread, Event, Lock, current_thread
+from collections import deque
 import time 
+import traceback
+
+
+class GameScheduler:
+    """Ticks the thermometer of every registered CookingGame from one
+    background thread, instead of one sleeping thread per game.
+
+    Each game is ticked `tick_rate` times per second until it is served
+    or has had `max_ticks` ticks. The thread exits when no games are left
+    (and is restarted by the next `register`), and `stop()` cancels it
+    immediately. The time taken to tick all games, and how late each tick
+    started, are kept for `metrics()`. A game whose thermometer raises is
+    unregistered, and the traceback printed and kept in `errors`.
+    """
+    def __init__(self, tick_rate=1.0, max_ticks=20_000, history=1000):
+        self.tick_rate = tick_rate
+        self.max_ticks = max_ticks
+        self.games = {}
+        self.lock = Lock()
+        self.stopping = Event()
+        self.thread = None
+        self.ticks = 0
+        self.latencies = deque(maxlen=history)
+        self.lateness = deque(maxlen=history)
+        self.errors = deque(maxlen=history)
+
+    def register(self, game):
+        with self.lock:
+            self.games[game] = 0
+            if self.thread is None:
+                # each thread gets its own stop event, so a thread that is
+                # being stopped can never miss it if a new one starts
+                self.stopping = Event()
+                self.thread = Thread(target=self.run, args=(self.stopping,), daemon=True)
+                self.thread.start()
+
+    def unregister(self, game):
+        with self.lock:
+            self.games.pop(game, None)
+
+    def stop(self):
+        """Cancel the scheduler and forget all games"""
+        with self.lock:
+            self.stopping.set()
+            thread, self.thread = self.thread, None
+            self.games.clear()
+        if thread is not None:
+            thread.join()
+
+    def run(self, stopping):
+        try:
+            next_tick = time.perf_counter()
+            while not stopping.is_set():
+                start = time.perf_counter()
+                self.lateness.append(start - next_tick)
+                with self.lock:
+                    if not self.games:
+                        self.thread = None
+                        return
+                    games = list(self.games.items())
+                for game, ticks in games:
+                    if game.stopping or ticks >= self.max_ticks:
+                        self.unregister(game)
+                        continue
+                    try:
+                        game.thermometer()
+                    except Exception:
+                        # a broken game only stops itself, not the others
+                        self.errors.append((game, traceback.format_exc()))
+                        traceback.print_exc()
+                        self.unregister(game)
+                        continue
+                    with self.lock:
+                        if game in self.games:
+                            self.games[game] = ticks + 1
+                self.ticks += 1
+                self.latencies.append(time.perf_counter() - start)
+                # if we have overrun, start the next tick straight away
+                next_tick = max(next_tick + 1.0 / self.tick_rate, time.perf_counter())
+                stopping.wait(next_tick - time.perf_counter())
+        finally:
+            with self.lock:
+                if self.thread is current_thread():
+                    self.thread = None
+
+    def metrics(self):
+        """Number of games, ticks and failed games so far, and the mean, 95th
+        percentile and maximum time (ms) to tick all games, and mean lateness (ms)"""
+        latencies = np.array(self.latencies) * 1000.0
+        lateness = np.array(self.lateness) * 1000.0
+        if len(latencies) == 0:
+            latencies = lateness = np.zeros(1)
+        return {"games": len(self.games), "ticks": self.ticks, "errors": len(self.errors),
+                "mean_ms": np.mean(latencies), "p95_ms": np.percentile(latencies, 95),
+                "max_ms": np.max(latencies), "late_ms": np.mean(lateness)}
+
+
+default_scheduler = GameScheduler()
 
 def create_game_ui(k):    
     game = CookingGame(k=k)
@@ -59,7 +157,7 @@ def create_game_ui(k):
 
 
 class CookingGame:
-    def __init__(self, k):
+    def __init__(self, k, scheduler=None):
         self.therm_label = None
         self.k = k # thermometer smoothing
         self.chilled = random.choice(["room temperature", "chilled", "frozen"])        
@@ -82,7 +180,9 @@ class CookingGame:
         self.stopping = False
         self.score = 0
         self.out = None
-        Thread(target=self.update_loop).start()
+        # games share one scheduler thread, rather than one thread each
+        self.scheduler = scheduler or default_scheduler
+        self.scheduler.register(self)
 
     def score_food(self):
         """Return the total thermometer time, the total number of moves,
@@ -169,14 +269,6 @@ class CookingGame:
         
         return score
 
-    def update_loop(self):
-        for i in range(20_000):
-            self.thermometer()
-            time.sleep(1.0)
-            if self.stopping:
-                break
-        
-
     def thermometer(self):
         # compute the measured temperature
         food_temp = food_model(self.radius, self.thermometer_insert, self.init_temp, self.oven_temp, self.cooking_time, self.density, self.heat_capacity)
@@ -200,6 +292,34 @@ def meat_utility(temps, mn, mx):
     ctr = (mx+mn)/2
     utility = np.where(temps<mn, -1*((mn-temps)**2), np.where(temps>mx, -0.45/rnge*((temps-mx)**2), 1-0.01*(temps-ctr)**2))
     return np.exp(utility/10.0)
+
+
+# meat_utility for each meat in meat_names, tabulated once on a fine grid.
+# meat_utility jumps at mn and mx, so each cell interpolates between the
+# one-sided limits at its ends (utility_base + utility_slope * frac); the
+# step is a power of two so integer temperatures fall exactly on nodes
+table_temps = np.arange(-128, 128 + 1/16, 1/16)
+utility_table, utility_left, utility_right = (
+    np.array([meat_utility(table_temps + eps, mn, mx) for mn, mx, density in meat_temps.values()])
+    for eps in [0, -1e-9, 1e-9])
+utility_base = utility_right[:, :-1].ravel()
+utility_slope = (utility_left[:, 1:] - utility_right[:, :-1]).ravel()
+
+def utility_lookup(temps, meat):
+    """meat_utility of temps (clipped to +-128C), interpolated from
+    utility_table. meat is a name, or an array of indices into meat_names
+    broadcastable with temps"""
+    if isinstance(meat, str):
+        meat = meat_names.index(meat)
+    pos = (np.clip(temps, -128, 128 - 1e-9) + 128) * 16
+    i = pos.astype(np.intp)
+    frac = pos - i
+    cell = i + np.asarray(meat) * (len(table_temps) - 1)
+    utility = utility_base.take(cell) + utility_slope.take(cell) * frac
+    exact = frac == 0
+    if np.any(exact):
+        utility = np.where(exact, utility_table[meat, i], utility)
+    return utility
     
     
 def plot_chicken_curve(foods):
@@ -241,9 +361,12 @@ def plot_utility_curves(foods):
 def get_mass(radius, density):
     return 0.25 * radius ** 3.0 * density
 
-def food_model(radius, insertion_depth, init_temp, cooking_temp, cooking_time, density, heat_capacity):
+def food_model(radius, insertion_depth, init_temp, cooking_temp, cooking_time, density, heat_capacity, rng=None):
+        rng = np.random if rng is None else rng
         mass = get_mass(radius, density)
-        alpha = 1.0/((np.sqrt(mass)  * heat_capacity) * (abs(insertion_depth)+radius/2)+1+np.random.normal(0, 0.001))            
+        # one perturbation per piece of food (radius has one entry per game)
+        jitter = rng.normal(0, 0.001, np.shape(radius))
+        alpha = 1.0/((np.sqrt(mass)  * heat_capacity) * (abs(insertion_depth)+radius/2)+1+jitter)            
         temp = cooking_temp + (init_temp - cooking_temp) * np.exp(-alpha * cooking_time)
         
         temp = np.tanh(temp/120) * 120
@@ -254,6 +377,117 @@ def thermometer(real_temp, init_temp, watch_time, noise_level, beta):
     temp = real_temp + (init_temp - real_temp) * np.exp(-beta * watch_time)
     temp = temp + np.random.normal(0, noise_level, temp.shape)
     return temp
+
+
+def draw_games(n, k, rng=None):
+    """Draw n games as arrays, as CookingGame.__init__ does for one.
+    Meat and chilled state are indices into meat_names and chill_names"""
+    rng = np.random.default_rng(rng)
+    mn, mx, _ = np.array([meat_temps[m] for m in meat_names]).T
+    best = np.array([optimal_temps(m)[1] for m in meat_names])
+    meat = rng.integers(0, len(meat_names), n)
+    chilled = rng.integers(0, len(chill_names), n)
+    radius = rng.uniform(2.5, 5.5, n) ** 2
+    return {"meat": meat, "chilled": chilled,
+            "init_temp": np.array([init_temps[c] for c in chill_names])[chilled],
+            "radius": radius, "mass": get_mass(radius, 0.9),
+            "oven_temp": rng.integers(0, 5, n) * 10 + 150,
+            "insert": rng.uniform(radius / 4, 3 * radius / 4),
+            "mn": mn[meat], "mx": mx[meat], "best": best[meat],
+            "k": np.broadcast_to(np.asarray(k, dtype=float), (n,)).copy()}
+
+
+def score_games(games, cooking_time, thermometer_time, chunk=10_000, rng=None):
+    """Vectorised CookingGame.score_food and serve for arrays of games.
+    Returns a dict of score, goodness, over, under and frozen arrays"""
+    n = len(games["radius"])
+    out = {key: np.zeros(n) for key in ["goodness", "over", "under"]}
+    out["frozen"] = np.zeros(n, dtype=bool)
+    for i in range(0, n, chunk):
+        s = slice(i, i + chunk)
+        radius = games["radius"][s, None]
+        distances = np.linspace(0, 1, 100) * radius
+        temps = food_model(radius, distances, games["init_temp"][s, None], games["oven_temp"][s, None],
+                           np.asarray(cooking_time)[s, None], 1.0, 0.1, rng)
+        mn, mx = games["mn"][s, None], games["mx"][s, None]
+        out["goodness"][s] = np.mean(utility_lookup(temps, games["meat"][s, None]), axis=1)
+        out["over"][s] = np.max(temps - mx, axis=1)
+        out["under"][s] = np.min(temps - mn, axis=1)
+        out["frozen"][s] = np.any(temps < 0, axis=1)
+    out["score"] = -thermometer_time + out["goodness"] * 500.0
+    return out
+
+
+def simulate_games(policy, n=100_000, k=1.0, max_steps=20_000, rng=None, games=None):
+    """Play n games headlessly, one thermometer tick (one second) per step.
+
+    Each step, `policy(obs)` is called with a dict of arrays for the games
+    still in play: the game description (as `draw_games`), the thermometer
+    `reading` (nan straight after cooking, as the UI shows), `watch_time`
+    and `cooking_time`. It returns `(cook, serve)`: minutes to cook each game
+    for (0 to keep watching) and a boolean array of games to serve. Games
+    still in play after `max_steps` are served.
+
+    All randomness is drawn from `rng`, so a seed reproduces a run.
+    Returns a dict of arrays, the games merged with their scores."""
+    rng = np.random.default_rng(rng)
+    games = dict(games or draw_games(n, k, rng))
+    n = len(games["radius"])
+    noise_level, beta = noise_latency(games["k"])
+    # the games still in play, compacted whenever any are served
+    g = dict(games, insert=games["insert"].copy())
+    state = {"index": np.arange(n), "cooking_time": np.zeros(n), "watch_time": np.zeros(n),
+             "thermometer_time": np.zeros(n), "noise_level": noise_level, "beta": beta,
+             "food_temp": food_model(g["radius"], g["insert"], g["init_temp"], g["oven_temp"], 0.0, 1.0, 0.1, rng)}
+    cooking_time, thermometer_time = np.zeros(n), np.zeros(n)
+    for step in range(max_steps):
+        live = len(state["index"])
+        if live == 0:
+            break
+        # as thermometer(), but with independent noise for each game
+        food_temp = state["food_temp"]
+        b = state["beta"] + rng.normal(0, 0.2, live)
+        reading = food_temp + (20 - food_temp) * np.exp(-b * state["watch_time"])
+        reading += rng.normal(0, state["noise_level"])
+        reading[state["watch_time"] == 0] = np.nan
+        state["watch_time"] += 1 / 60.0
+        state["thermometer_time"] += 1 / 60.0
+
+        cook, serve = policy(dict(g, reading=reading, watch_time=state["watch_time"],
+                                  cooking_time=state["cooking_time"]))
+        cook = np.broadcast_to(cook, (live,))
+        cooked = cook > 0
+        if np.any(cooked):
+            radius = g["radius"][cooked]
+            g["insert"][cooked] = rng.normal(radius, radius / 3)
+            state["cooking_time"][cooked] += cook[cooked]
+            state["watch_time"][cooked] = 0
+            state["food_temp"][cooked] = food_model(radius, g["insert"][cooked], g["init_temp"][cooked],
+                                                    g["oven_temp"][cooked], state["cooking_time"][cooked], 1.0, 0.1, rng)
+        serve = np.broadcast_to(serve, (live,))
+        if np.any(serve):
+            done = state["index"][serve]
+            cooking_time[done] = state["cooking_time"][serve]
+            thermometer_time[done] = state["thermometer_time"][serve]
+            g = {key: v[~serve] for key, v in g.items()}
+            state = {key: v[~serve] for key, v in state.items()}
+
+    # serve anything left after max_steps
+    cooking_time[state["index"]] = state["cooking_time"]
+    thermometer_time[state["index"]] = state["thermometer_time"]
+    scores = score_games(games, cooking_time, thermometer_time, rng=rng)
+    return dict(games, cooking_time=cooking_time, thermometer_time=thermometer_time, **scores)
+
+
+def probe_policy(watch=5.0, minutes=30, margin=0.0):
+    """A simple policy for simulate_games: watch the thermometer for `watch`
+    minutes, then cook for `minutes` more if the reading is below the best
+    temperature (plus `margin`), otherwise serve"""
+    def policy(obs):
+        ready = obs["watch_time"] >= watch
+        cold = obs["reading"] < obs["best"] + margin
+        return np.where(ready & cold, minutes, 0), ready & ~cold
+    return policy
     
     
 
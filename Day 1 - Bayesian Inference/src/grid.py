@@ -1,54 +1,127 @@
-from bisect import bisect
+import numpy as np
+import scipy.stats as ss
+import scipy.signal
+
+
+def _nearest(domain, v):
+    """Return the index of the element of a sorted domain nearest v
+    (v may be an array, in which case an array of indices is returned)"""
+    v = np.asarray(v)
+    assert np.all((domain[0] <= v) & (v <= domain[-1]))
+    i = np.clip(np.searchsorted(domain, v), 1, len(domain) - 1)
+    i = np.where(v - domain[i - 1] < domain[i] - v, i - 1, i)
+    return int(i) if i.ndim == 0 else i
+
+
+def _posterior(prior, lik, log=False, axis=0, rows=False):
+    """Multiply a prior by a stack of likelihoods (summed over `axis`),
+    working in log space. Returns unnormalised values scaled so the
+    largest value is 1 (or the largest in each row, if `rows` is True)."""
+    with np.errstate(divide="ignore"):
+        log_post = np.log(prior)
+        if not log:
+            lik = np.log(lik)
+    log_post = log_post + np.sum(lik, axis=axis)
+    peak = np.max(log_post, axis=-1, keepdims=True) if rows else np.max(log_post)
+    if not np.all(np.isfinite(peak)):
+        raise ValueError("the observations have zero probability under the prior "
+                         "and likelihood, so the posterior is undefined")
+    return np.exp(log_post - peak)
 
 
 class Grid:
+    """A discrete distribution over a sorted 1D domain.
+
+    Probabilities are stored in a NumPy array aligned with `domain`.
+    A cumulative sum of the values is built lazily the first time it is
+    needed, so range queries are two binary searches and a subtraction.
+    Assigning to `values` (or setting a bin) invalidates it; if you modify
+    the array in place, call `touch()` afterwards.
+    """
+
     def __init__(self, domain):
-        self.domain = domain
-        self.values = {d: 1.0 / len(domain) for d in domain}
+        self.domain = np.asarray(domain, dtype=np.float64)
+        self.values = np.full(len(self.domain), 1.0 / len(self.domain))
 
     @classmethod
     def uniform(cls, start, stop, n):
         """Create a uniform grid from start to stop, with n steps"""
-        return Grid(np.linspace(start, stop, n))
+        return cls(np.linspace(start, stop, n))
+
+    @property
+    def values(self):
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        self._values = np.asarray(values, dtype=np.float64)
+        self.touch()
+
+    def touch(self):
+        """Mark the values as changed, so the cumulative sum is rebuilt"""
+        self._cumsum = None
+
+    @property
+    def cumsum(self):
+        """Cumulative sum of the values, with a leading zero"""
+        if self._cumsum is None:
+            self._cumsum = np.concatenate([[0.0], np.cumsum(self._values)])
+        return self._cumsum
 
     def delta(self, delta):
         """Create a a grid with all probability on one outcome"""
-        self.values = {d: 0 for d in self.domain}
-        g[delta] = 1.0
+        self.values = np.zeros_like(self.domain)
+        self[delta] = 1.0
 
     def norm(self, mean, std):
         """Create a a grid with approximately Gaussian distribuion"""
-        self.values = {d: ss.norm(mean, std).pdf(d) for d in self.domain}
+        self.values = ss.norm(mean, std).pdf(self.domain)
         self.normalise()
 
     def at(self, v):
-        """Return the index of the grid element with the given value."""
-        assert np.min(self.domain) <= v <= np.max(self.domain)
-        return bisect(self.domain, v)
+        """Return the index of the grid element nearest the given value."""
+        return _nearest(self.domain, v)
 
     def __getitem__(self, v):
         """Return the value associated with the bin nearest v"""
-        return self.values[self.domain[self.at(v)]]
+        return self._values[self.at(v)]
 
     def __setitem__(self, v, p):
         """Set the value associated with the bin nearest v"""
-        self.values[self.domain[self.at(v)]] = p
+        self._values[self.at(v)] = p
+        self.touch()
 
     def integrate(self, start=None, stop=None):
-        """Return the sum of probabilities inside a range"""
-        if start is None:
-            start = self.domain[0]
-
-        if stop is None:
-            stop = self.domain[-1]
-        return sum(
-            [self.values[d] for d in self.domain[self.at(start) : self.at(stop)]]
-        )
+        """Return the sum of probabilities of the bins in [start, stop]"""
+        i = 0 if start is None else np.searchsorted(self.domain, start, side="left")
+        j = len(self.domain) if stop is None else np.searchsorted(self.domain, stop, side="right")
+        cumsum = self.cumsum
+        return cumsum[max(i, j)] - cumsum[i]
 
     def normalise(self):
         """Normalise a distribution"""
         total = self.integrate()
-        self.values = {d: v / total for d, v in self.values.items()}
+        self._values /= total
+        # rescale the cumulative sum rather than rebuilding it
+        self._cumsum /= total
+
+    def update(self, likelihood_fn, observations, log=False):
+        """Apply Bayes' rule for a batch of observations.
+
+        `likelihood_fn(x, y)` must broadcast: it is called once with the
+        domain as a (1, n) array and the observations as a (k, 1) array,
+        and should return a (k, n) array of likelihoods (or
+        log-likelihoods, if `log` is True). The batch is combined in log
+        space and the grid is normalised once at the end.
+        """
+        observations = np.asarray(observations, dtype=np.float64).reshape(-1, 1)
+        lik = np.broadcast_to(
+            likelihood_fn(self.domain[None, :], observations),
+            (len(observations), len(self.domain)),
+        )
+        self.values = _posterior(self._values, lik, log)
+        self.normalise()
+        return self
 
     def __str__(self):
         """Print out the grid descriptor"""
@@ -64,13 +137,259 @@ class Grid:
             q = int(np.clip(0, q + len(bars) / 2, len(bars) - 1))
             return bars[q]
 
-        return f"{self.domain[0]:.1f} {' '.join(map_char(p) for p in self.values.values())} {self.domain[-1]:.1f}"
+        return f"{self.domain[0]:.1f} {' '.join(map_char(p) for p in self.values)} {self.domain[-1]:.1f}"
 
     def __repr__(self):
         return str(self)
 
 
-g = Grid.uniform(0, 1, 10)
-g.delta(0.5)
-g
-g
+class ProductGrid:
+    """A discrete distribution over the product of several sorted 1D
+    domains, e.g. position x velocity. `values` is an N-D array with one
+    axis per domain."""
+
+    def __init__(self, domains):
+        self.domains = [np.asarray(d, dtype=np.float64) for d in domains]
+        self.shape = tuple(len(d) for d in self.domains)
+        self.values = np.full(self.shape, 1.0 / np.prod(self.shape))
+
+    @classmethod
+    def uniform(cls, bounds, n):
+        """Create a uniform grid from a list of (start, stop) bounds, with
+        n steps on each axis (n can be a list, one per axis)"""
+        n = np.broadcast_to(n, (len(bounds),))
+        return cls([np.linspace(start, stop, k) for (start, stop), k in zip(bounds, n)])
+
+    @property
+    def ndim(self):
+        return len(self.domains)
+
+    def mesh(self):
+        """Return one broadcastable array of coordinates per axis"""
+        return np.meshgrid(*self.domains, indexing="ij", sparse=True)
+
+    def delta(self, point):
+        """Create a grid with all probability on one outcome"""
+        self.values = np.zeros(self.shape)
+        self[point] = 1.0
+
+    def norm(self, mean, std):
+        """Create a grid with an approximately Gaussian distribution, with
+        independent axes"""
+        mean = np.broadcast_to(mean, (self.ndim,))
+        std = np.broadcast_to(std, (self.ndim,))
+        values = 1.0
+        for x, m, s in zip(self.mesh(), mean, std):
+            values = values * ss.norm(m, s).pdf(x)
+        self.values = values
+        self.normalise()
+
+    def at(self, point):
+        """Return the index tuple of the grid element nearest the given point"""
+        return tuple(_nearest(d, v) for d, v in zip(self.domains, point))
+
+    def __getitem__(self, point):
+        return self.values[self.at(point)]
+
+    def __setitem__(self, point, p):
+        self.values[self.at(point)] = p
+
+    def normalise(self):
+        """Normalise a distribution"""
+        self.values /= np.sum(self.values)
+
+    def _wrap(self, values, axes):
+        """Wrap values over a subset of axes as a Grid or ProductGrid"""
+        if len(axes) == 1:
+            grid = Grid(self.domains[axes[0]])
+        else:
+            grid = ProductGrid([self.domains[a] for a in axes])
+        grid.values = values
+        grid.normalise()
+        return grid
+
+    def marginal(self, axes):
+        """Return the marginal distribution over the given axis (or list of
+        axes), summing out all of the others"""
+        axes = sorted(np.atleast_1d(axes).tolist())
+        others = tuple(a for a in range(self.ndim) if a not in axes)
+        return self._wrap(np.sum(self.values, axis=others), axes)
+
+    def condition(self, axis, v):
+        """Return the distribution over the remaining axes, given that axis
+        takes the value nearest v"""
+        index = [slice(None)] * self.ndim
+        index[axis] = _nearest(self.domains[axis], v)
+        axes = [a for a in range(self.ndim) if a != axis]
+        return self._wrap(np.array(self.values[tuple(index)]), axes)
+
+    def update(self, likelihood_fn, observations, log=False):
+        """Apply Bayes' rule for a batch of scalar observations.
+
+        `likelihood_fn(x, y)` is called once, with `x` the list of
+        coordinate arrays from `mesh()` and `y` the observations shaped
+        (k, 1, ..., 1), and should return likelihoods broadcastable to
+        (k,) + shape (or log-likelihoods, if `log` is True).
+        """
+        observations = np.asarray(observations, dtype=np.float64)
+        observations = observations.reshape((-1,) + (1,) * self.ndim)
+        mesh = [x[None] for x in self.mesh()]
+        lik = np.broadcast_to(
+            likelihood_fn(mesh, observations), (len(observations),) + self.shape
+        )
+        self.values = _posterior(self.values, lik, log)
+        self.normalise()
+        return self
+
+    def gaussian_kernel(self, std, shift=0.0, width=4.0):
+        """Return a motion kernel for `predict`: a Gaussian with the given
+        std. dev. on each axis, displaced by shift (both in domain units).
+        Axes are assumed to be evenly spaced."""
+        std = np.broadcast_to(std, (self.ndim,))
+        shift = np.broadcast_to(shift, (self.ndim,))
+        kernel = 1.0
+        for i, (d, s, m) in enumerate(zip(self.domains, std, shift)):
+            step = d[1] - d[0]
+            half = int(np.ceil((abs(m) + width * s) / step))
+            x = np.arange(-half, half + 1) * step
+            if s > 0:
+                k = ss.norm(m, s).pdf(x)
+            else:
+                k = (np.abs(x - m) <= step / 2) * 1.0
+            shape = [1] * self.ndim
+            shape[i] = -1
+            kernel = kernel * (k / np.sum(k)).reshape(shape)
+        return kernel
+
+    def predict(self, kernel):
+        """Apply a shift-invariant motion kernel (an N-D array with odd side
+        lengths, centred on zero displacement) to the distribution, using
+        FFT convolution. Mass pushed off the edge of the grid is lost and
+        the result is renormalised."""
+        values = scipy.signal.fftconvolve(self.values, kernel, mode="same")
+        # FFT round-off can produce tiny negative values
+        self.values = np.clip(values, 0, None)
+        self.normalise()
+        return self
+
+    def __repr__(self):
+        return f"ProductGrid({' x '.join(f'[{d[0]:.1f}..{d[-1]:.1f}]/{len(d)}' for d in self.domains)})"
+
+
+class GridBank:
+    """Many independent distributions over the same sorted 1D domain,
+    stacked as the rows of a single (n_grids, n_bins) array, so that a
+    whole population (e.g. one posterior per user session) can be
+    initialised, updated and queried with a few array operations.
+
+    Like Grid, a per-row cumulative sum is maintained lazily for
+    `integrate`; call `touch()` after modifying `values` in place.
+    """
+
+    def __init__(self, domain, n_grids):
+        self.domain = np.asarray(domain, dtype=np.float64)
+        self.values = np.full((n_grids, len(self.domain)), 1.0 / len(self.domain))
+
+    @classmethod
+    def uniform(cls, start, stop, n, n_grids):
+        """Create n_grids uniform grids from start to stop, with n steps"""
+        return cls(np.linspace(start, stop, n), n_grids)
+
+    @property
+    def values(self):
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        self._values = np.asarray(values, dtype=np.float64)
+        self.touch()
+
+    def touch(self):
+        """Mark the values as changed, so the cumulative sums are rebuilt"""
+        self._cumsum = None
+
+    @property
+    def cumsum(self):
+        """Per-row cumulative sums of the values, with a leading zero"""
+        if self._cumsum is None:
+            self._cumsum = np.zeros((len(self), len(self.domain) + 1))
+            np.cumsum(self._values, axis=1, out=self._cumsum[:, 1:])
+        return self._cumsum
+
+    def __len__(self):
+        return len(self._values)
+
+    def _rows(self, rows):
+        """All rows as a slice (so updates are views), or the selected rows
+        (a scalar, slice, mask or index list) as an array of indices"""
+        return slice(None) if rows is None else np.atleast_1d(np.arange(len(self))[rows])
+
+    def delta(self, deltas, rows=None):
+        """Put all of the probability of each row on one outcome; deltas
+        is a scalar or one value per row"""
+        rows = self._rows(rows)
+        self._values[rows] = 0.0
+        index = np.arange(len(self))[rows]
+        self._values[index, _nearest(self.domain, np.broadcast_to(deltas, index.shape))] = 1.0
+        self.touch()
+
+    def norm(self, mean, std, rows=None):
+        """Set each row to an approximately Gaussian distribution; mean and
+        std are scalars or one value per row"""
+        rows = self._rows(rows)
+        mean = np.asarray(mean, dtype=np.float64)[..., None]
+        std = np.asarray(std, dtype=np.float64)[..., None]
+        self._values[rows] = ss.norm(mean, std).pdf(self.domain[None, :])
+        self.touch()
+        self.normalise(rows)
+
+    def normalise(self, rows=None):
+        """Normalise each row to sum to 1"""
+        rows = self._rows(rows)
+        self._values[rows] /= np.sum(self._values[rows], axis=1, keepdims=True)
+        self.touch()
+
+    def update(self, likelihood_fn, observations, log=False, rows=None):
+        """Apply Bayes' rule to each row with its own batch of observations.
+
+        observations has one entry per updated row, or shape (rows, k) for
+        k observations per row. `likelihood_fn(x, y)` must broadcast: it
+        is called once with the domain as a (1, 1, n) array and the
+        observations as a (rows, k, 1) array, and should return
+        likelihoods (or log-likelihoods, if `log` is True) broadcastable
+        to (rows, k, n). Each row is normalised once per batch.
+        """
+        rows = self._rows(rows)
+        prior = self._values[rows]
+        observations = np.asarray(observations, dtype=np.float64)
+        observations = observations.reshape(len(prior), -1)[:, :, None]
+        lik = np.broadcast_to(
+            likelihood_fn(self.domain[None, None, :], observations),
+            observations.shape[:2] + (len(self.domain),),
+        )
+        self._values[rows] = _posterior(prior, lik, log, axis=1, rows=True)
+        self.normalise(rows)
+        return self
+
+    def integrate(self, start=None, stop=None, rows=None):
+        """Return the per-row sum of probabilities of the bins in
+        [start, stop]; start and stop are scalars or one value per row"""
+        index = np.arange(len(self))[self._rows(rows)]
+        if np.ndim(rows) == 0 and rows is not None:
+            # a single row gives a scalar, as it always has
+            index = index[0]
+        n = len(self.domain)
+        i = 0 if start is None else np.searchsorted(self.domain, start, side="left")
+        j = n if stop is None else np.searchsorted(self.domain, stop, side="right")
+        i, j = np.broadcast_arrays(i, j, index)[:2]
+        cumsum = self.cumsum
+        return cumsum[index, np.maximum(i, j)] - cumsum[index, i]
+
+    def grid(self, row):
+        """Return a copy of one row as a Grid"""
+        grid = Grid(self.domain)
+        grid.values = np.array(self._values[row])
+        return grid
+
+    def __repr__(self):
+        return f"GridBank({len(self)} x [{self.domain[0]:.1f}..{self.domain[-1]:.1f}]/{len(self.domain)})"